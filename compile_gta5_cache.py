@@ -0,0 +1,71 @@
+import argparse
+import os.path as osp
+import numpy as np
+import time
+from multiprocessing import Pool
+from PIL import Image, ImageFile
+from dataset.gta5_dataset import GTA5DataSet
+from dataset.memmap_store import MemmapStoreWriter
+from utils.label_mapping import map_labels
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+DATA_DIRECTORY = './data/GTA5'
+DATA_LIST_PATH = './dataset/gta5_list/train.txt'
+SAVE_PATH = './data/GTA5/cache_1280x720'
+INPUT_SIZE = '1280,720'
+SHARD_SIZE = 1000
+NUM_WORKERS = 8
+
+
+def get_arguments():
+    """Parse all the arguments provided from the CLI.
+
+    Returns:
+      A list of parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Compile GTA5 into a memory-mapped shard cache")
+    parser.add_argument("--data-dir", type=str, default=DATA_DIRECTORY,
+                        help="Path to the directory containing the source dataset.")
+    parser.add_argument("--data-list", type=str, default=DATA_LIST_PATH,
+                        help="Path to the file listing the images in the source dataset.")
+    parser.add_argument("--input-size", type=str, default=INPUT_SIZE,
+                        help="Comma-separated string with width and height of the cached images.")
+    parser.add_argument("--save", type=str, default=SAVE_PATH,
+                        help="Directory to write the shards and index to.")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE,
+                        help="Number of images per shard file.")
+    parser.add_argument("--num-workers", type=int, default=NUM_WORKERS,
+                        help="Number of processes used to decode and resize.")
+    return parser.parse_args()
+
+
+def load(job):
+    img_file, label_file, resize_size, lut = job
+    image = Image.open(img_file).convert('RGB').resize(resize_size, Image.BICUBIC)
+    label = np.asarray(Image.open(label_file).resize(resize_size, Image.NEAREST), np.uint8)
+    return np.asarray(image, np.uint8), map_labels(label, lut)
+
+
+def main():
+    args = get_arguments()
+    w, h = map(int, args.input_size.split(','))
+
+    dst = GTA5DataSet(args.data_dir, args.data_list, resize_size=(w, h))
+    names = [f['name'] for f in dst.files]
+    jobs = [(f['img'], f['label'], (w, h), dst.lut) for f in dst.files]
+
+    writer = MemmapStoreWriter(args.save, names, {'image': ((h, w, 3), 'uint8'), 'label': ((h, w), 'uint8')},
+                               shard_size=args.shard_size, meta={'resize_size': [w, h]})
+    tt = time.time()
+    with Pool(args.num_workers) as p:
+        for index, (image, label) in enumerate(p.imap(load, jobs, chunksize=4)):
+            writer.write(index, image=image, label=label)
+            if index % 100 == 0:
+                print('\r>>>>Compiling...%05d/%05d %.1f img/s' % (index, len(jobs), (index + 1) / (time.time() - tt)), end='')
+    writer.close()
+    print('\nCache written to %s' % osp.abspath(args.save))
+
+
+if __name__ == '__main__':
+    main()
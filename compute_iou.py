@@ -1,8 +1,13 @@
 import numpy as np
 import argparse
+import torch
 import json
+import time
+from multiprocessing import Pool
 from PIL import Image
 from os.path import join
+from dataset.gt_store import open_gt_store
+from utils.label_mapping import build_lut, map_labels
 
 
 def fast_hist(a, b, n):
@@ -10,27 +15,58 @@ def fast_hist(a, b, n):
     return np.bincount(n * a[k].astype(int) + b[k], minlength=n ** 2).reshape(n, n)
 
 
+def fast_hist_torch(a, b, n):
+    """fast_hist on (device) tensors, a is the ground truth and b the prediction."""
+    k = (a >= 0) & (a < n)
+    return torch.bincount(n * a[k].long() + b[k].long(), minlength=n ** 2).view(n, n)
+
+
+def fast_hist_uint8(a, b, n):
+    """ fast_hist for uint8 label maps without the int64 casts and masked copies.
+
+        Every (gt, pred) pair is packed into one uint16 index, the 256x256
+        bincount is then cropped to n x n, which also drops the ignore label.
+    """
+    index = np.left_shift(a.ravel(), 8, dtype=np.uint16)
+    index |= b.ravel()
+    return np.bincount(index, minlength=256 * 256).reshape(256, 256)[:n, :n]
+
+
 def per_class_iu(hist):
     return np.diag(hist) / (hist.sum(1) + hist.sum(0) - np.diag(hist))
 
 
 def label_mapping(input, mapping):
-    output = np.copy(input)
-    for ind in range(len(mapping)):
-        output[input == mapping[ind][0]] = mapping[ind][1]
-    return np.array(output, dtype=np.int64)
+    lut = build_lut(mapping, fill=None, dtype=np.int64)
+    return map_labels(input, lut)
+
+
+def load_info(devkit_dir=''):
+    """Return num_classes, name_classes and the label2train mapping of info.json."""
+    with open(join(devkit_dir, 'info.json'), 'r') as fp:
+      info = json.load(fp)
+    num_classes = int(info['classes'])
+    name_classes = np.array(info['label'], dtype=str)
+    mapping = np.array(info['label2train'], dtype=int)
+    return num_classes, name_classes, mapping
+
+
+def print_mIoU(hist, name_classes):
+    """Print the per-class IoUs and the mIoU of a confusion matrix."""
+    mIoUs = per_class_iu(hist)
+    for ind_class in range(len(name_classes)):
+        print(('===>' + name_classes[ind_class] + ':\t' + str(round(mIoUs[ind_class] * 100, 2))))
+    print(('===> mIoU: ' + str(round(np.nanmean(mIoUs) * 100, 2))))
+    return mIoUs
 
 
 def compute_mIoU(gt_dir, pred_dir, devkit_dir=''):
     """
     Compute IoU given the predicted colorized images and 
     """
-    with open(join(devkit_dir, 'info.json'), 'r') as fp:
-      info = json.load(fp)
-    num_classes = np.int(info['classes'])
+    num_classes, name_classes, mapping = load_info(devkit_dir)
     print(('Num classes', num_classes))
-    name_classes = np.array(info['label'], dtype=np.str)
-    mapping = np.array(info['label2train'], dtype=np.int)
+    lut = build_lut(mapping, fill=None, dtype=np.int64)
     hist = np.zeros((num_classes, num_classes))
 
     image_path_list = join(devkit_dir, 'val.txt')
@@ -43,7 +79,7 @@ def compute_mIoU(gt_dir, pred_dir, devkit_dir=''):
     for ind in range(len(gt_imgs)):
         pred = np.array(Image.open(pred_imgs[ind]))
         label = np.array(Image.open(gt_imgs[ind]))
-        label = label_mapping(label, mapping)
+        label = map_labels(label, lut)
         if len(label.shape) == 3 and label.shape[2]==4:
             label = label[:,:,0]
         if len(label.flatten()) != len(pred.flatten()):
@@ -53,21 +89,98 @@ def compute_mIoU(gt_dir, pred_dir, devkit_dir=''):
         if ind > 0 and ind % 10 == 0:
             print(('{:d} / {:d}: {:0.2f}'.format(ind, len(gt_imgs), 100*np.mean(per_class_iu(hist)))))
     
-    mIoUs = per_class_iu(hist)
-    for ind_class in range(num_classes):
-        print(('===>' + name_classes[ind_class] + ':\t' + str(round(mIoUs[ind_class] * 100, 2))))
-    print(('===> mIoU: ' + str(round(np.nanmean(mIoUs) * 100, 2))))
+    return print_mIoU(hist, name_classes)
+
+
+def _read_label(path):
+    label = np.asarray(Image.open(path))
+    if len(label.shape) == 3:
+        label = label[:,:,0]
+    return label.astype(np.uint8, copy=False)
+
+
+def _hist_worker(job):
+    """Partial histograms of one shard, one per prediction directory."""
+    gt_imgs, gt_store, pred_imgs, lut, num_classes = job
+    hist = np.zeros((len(pred_imgs), num_classes, num_classes), dtype=np.int64)
+    skipped = []
+    for ind, gt_img in enumerate(gt_imgs):
+        # one gt read shared by all directories
+        if gt_store is not None:
+            label = gt_store.get('label', gt_img)
+        else:
+            label = map_labels(_read_label(gt_img), lut)
+        for d in range(len(pred_imgs)):
+            pred = _read_label(pred_imgs[d][ind])
+            if label.size != pred.size:
+                skipped.append('Skipping: len(gt) = {:d}, len(pred) = {:d}, {:s}, {:s}'.format(
+                    label.size, pred.size, gt_img, pred_imgs[d][ind]))
+                continue
+            hist[d] += fast_hist_uint8(label, pred, num_classes)
+    return hist, skipped
+
+
+def compute_mIoU_parallel(gt_dir, pred_dirs, devkit_dir='', num_workers=8, gt_cache=''):
+    """ compute_mIoU over a process pool, for one or several prediction directories.
+
+        The image list is split into shards, each worker returns the partial
+        histograms of its shard and the main process sums them up. With
+        `gt_cache` the remapped ground truth is read from (and on the first
+        run written to) a memory-mapped store in that directory.
+
+        Example:
+        >>> mIoUs = compute_mIoU_parallel(gt_dir, [pred_dir_a, pred_dir_b], 'dataset/cityscapes_list')
+    """
+    num_classes, name_classes, mapping = load_info(devkit_dir)
+    print(('Num classes', num_classes))
+    lut = build_lut(mapping)
+
+    gt_imgs = open(join(devkit_dir, 'label.txt'), 'r').read().splitlines()
+    if gt_cache:
+        gt_store = open_gt_store(gt_cache, gt_dir, gt_imgs, lut, num_workers)
+    else:
+        gt_store = None
+        gt_imgs = [join(gt_dir, x) for x in gt_imgs]
+    names = [x.split('/')[-1] for x in open(join(devkit_dir, 'val.txt'), 'r').read().splitlines()]
+    pred_imgs = [[join(pred_dir, x) for x in names] for pred_dir in pred_dirs]
+
+    num_shards = max(1, min(len(gt_imgs), num_workers * 4))
+    bounds = np.linspace(0, len(gt_imgs), num_shards + 1).astype(int)
+    jobs = [(gt_imgs[b:e], gt_store, [p[b:e] for p in pred_imgs], lut, num_classes)
+            for b, e in zip(bounds[:-1], bounds[1:])]
+
+    tt = time.time()
+    hist = np.zeros((len(pred_dirs), num_classes, num_classes), dtype=np.int64)
+    with Pool(num_workers) as p:
+        for ind, (shard_hist, skipped) in enumerate(p.imap(_hist_worker, jobs)):
+            hist += shard_hist
+            for message in skipped:
+                print(message)
+            print('\r{:d} / {:d} shards, {:.1f} img/s'.format(
+                ind + 1, len(jobs), bounds[ind + 1] / (time.time() - tt)), end='')
+    print('')
+
+    mIoUs = []
+    for pred_dir, h in zip(pred_dirs, hist):
+        print('>>>> %s' % pred_dir)
+        mIoUs.append(print_mIoU(h, name_classes))
     return mIoUs
 
 
 def main(args):
-   compute_mIoU(args.gt_dir, args.pred_dir, args.devkit_dir)
+    if args.num_workers > 0:
+        compute_mIoU_parallel(args.gt_dir, args.pred_dir, args.devkit_dir, args.num_workers, args.gt_cache)
+    else:
+        for pred_dir in args.pred_dir:
+            compute_mIoU(args.gt_dir, pred_dir, args.devkit_dir)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('gt_dir', type=str, help='directory which stores CityScapes val gt images')
-    parser.add_argument('pred_dir', type=str, help='directory which stores CityScapes val pred images')
+    parser.add_argument('pred_dir', type=str, nargs='+', help='directories which store CityScapes val pred images')
     parser.add_argument('--devkit_dir', default='dataset/cityscapes_list', help='base directory of cityscapes')
+    parser.add_argument('--num_workers', type=int, default=8, help='processes used to score the images, 0 runs serially')
+    parser.add_argument('--gt_cache', default='', help='directory of the cached train-id ground truth, built on first use')
     args = parser.parse_args()
     main(args)
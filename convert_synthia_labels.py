@@ -0,0 +1,64 @@
+import argparse
+import os
+import os.path as osp
+import numpy as np
+import time
+import imageio
+from multiprocessing import Pool
+from PIL import Image
+from dataset.synthia_dataset import SynthiaDataSet, TRAINID_LABEL_DIR
+from utils.label_mapping import map_labels
+
+DATA_DIRECTORY = './data/synthia'
+DATA_LIST_PATH = './dataset/synthia_list/train.txt'
+NUM_WORKERS = 8
+
+
+def get_arguments():
+    """Parse all the arguments provided from the CLI.
+
+    Returns:
+      A list of parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Convert SYNTHIA 16-bit labels to uint8 train-id PNGs")
+    parser.add_argument("--data-dir", type=str, default=DATA_DIRECTORY,
+                        help="Path to the directory containing the SYNTHIA dataset.")
+    parser.add_argument("--data-list", type=str, default=DATA_LIST_PATH,
+                        help="Path to the file listing the images in the dataset.")
+    parser.add_argument("--num-workers", type=int, default=NUM_WORKERS,
+                        help="Number of processes used to decode and write.")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Convert again labels that already exist.")
+    return parser.parse_args()
+
+
+def convert(job):
+    label_file, trainid_label_file, lut = job
+    label = np.asarray(imageio.imread(label_file, format='PNG-FI'))[:,:,0]  # uint16
+    # write to a temporary name first, the dataset only checks that files exist
+    tmp_file = trainid_label_file + '.tmp'
+    Image.fromarray(map_labels(label, lut)).save(tmp_file, format='PNG')
+    os.replace(tmp_file, trainid_label_file)
+
+
+def main():
+    args = get_arguments()
+
+    dst = SynthiaDataSet(args.data_dir, args.data_list)
+    save_dir = osp.join(args.data_dir, TRAINID_LABEL_DIR)
+    if not osp.exists(save_dir):
+        os.makedirs(save_dir)
+    jobs = [(f['label'], f['trainid_label'], dst.lut) for f in dst.files
+            if args.overwrite or not osp.isfile(f['trainid_label'])]
+    print('%d of %d labels to convert' % (len(jobs), len(dst.files)))
+
+    tt = time.time()
+    with Pool(args.num_workers) as p:
+        for index, _ in enumerate(p.imap_unordered(convert, jobs, chunksize=4)):
+            if index % 100 == 0:
+                print('\r>>>>Converting...%05d/%05d %.1f img/s' % (index, len(jobs), (index + 1) / (time.time() - tt)), end='')
+    print('\nTrain-id labels written to %s' % osp.abspath(save_dir))
+
+
+if __name__ == '__main__':
+    main()
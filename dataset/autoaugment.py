@@ -177,7 +177,7 @@ class SubPolicy(object):
             "translateY": np.linspace(0, 150 / 331, 10),
             "rotate": np.linspace(0, 30, 10),
             "color": np.linspace(0.0, 0.9, 10),
-            "posterize": np.round(np.linspace(8, 4, 10), 0).astype(np.int),
+            "posterize": np.round(np.linspace(8, 4, 10), 0).astype(int),
             "solarize": np.linspace(256, 0, 10),
             "contrast": np.linspace(0.0, 0.9, 10),
             "sharpness": np.linspace(0.0, 0.9, 10),
@@ -224,6 +224,7 @@ class SubPolicy(object):
         # self.name = "{}_{:.2f}_and_{}_{:.2f}".format(
         #     operation1, ranges[operation1][magnitude_idx1],
         #     operation2, ranges[operation2][magnitude_idx2])
+        self.names = (operation1, operation2)
         self.p1 = p1
         self.operation1 = func[operation1]
         self.magnitude1 = ranges[operation1][magnitude_idx1]
@@ -10,13 +10,15 @@ import torch
 import torchvision
 from torch.utils import data
 from PIL import Image, ImageFile
-from dataset.autoaugment import ImageNetPolicy
+from dataset.list_dataset import ListDataSet
+from dataset.crop_sampler import resize_crop
+from utils.label_mapping import build_lut, map_labels
 import time
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-class cityscapesDataSet(data.Dataset):
-    def __init__(self, root, list_path, max_iters=None, resize_size=(1024, 512), crop_size=(512, 1024), mean=(128, 128, 128), scale=True, mirror=True, ignore_label=255, set='val', autoaug=False):
+class cityscapesDataSet(ListDataSet):
+    def __init__(self, root, list_path, max_iters=None, resize_size=(1024, 512), crop_size=(512, 1024), mean=(128, 128, 128), scale=True, mirror=True, ignore_label=255, set='val', autoaug=False, return_uint8=False, crop_first=False):
         self.root = root
         self.list_path = list_path
         self.crop_size = crop_size
@@ -26,12 +28,13 @@ class cityscapesDataSet(data.Dataset):
         self.is_mirror = mirror
         self.resize_size = resize_size
         self.autoaug = autoaug
+        self.return_uint8 = return_uint8
+        self.crop_first = crop_first
         self.h = crop_size[0]
         self.w = crop_size[1]
         # self.mean_bgr = np.array([104.00698793, 116.66876762, 122.67891434])
         self.img_ids = [i_id.strip() for i_id in open(list_path)]
-        if not max_iters==None:
-            self.img_ids = self.img_ids * int(np.ceil(float(max_iters) / len(self.img_ids)))
+        self.set_num_samples(max_iters)
         self.files = []
         self.set = set
         # for split in ["train", "trainval", "val"]:
@@ -40,6 +43,7 @@ class cityscapesDataSet(data.Dataset):
         self.id_to_trainid = {7: 0, 8: 1, 11: 2, 12: 3, 13: 4, 17: 5,
                               19: 6, 20: 7, 21: 8, 22: 9, 23: 10, 24: 11, 25: 12,
                               26: 13, 27: 14, 28: 15, 31: 16, 32: 17, 33: 18}
+        self.lut = build_lut(self.id_to_trainid)
 
         for name in self.img_ids:
             img_file = osp.join(self.root, "leftImg8bit/%s/%s" % (self.set, name))
@@ -50,40 +54,45 @@ class cityscapesDataSet(data.Dataset):
                 "name": name
             })
 
-    def __len__(self):
-        return len(self.files)
-
     def __getitem__(self, index):
         #tt = time.time()
-        datafiles = self.files[index]
+        datafiles = self.files[index % len(self.files)]
         name = datafiles["name"]
 
         image, label = Image.open(datafiles["img"]).convert('RGB'), Image.open(datafiles["label"])
         # resize
-        image, label = image.resize(self.resize_size, Image.BICUBIC), label.resize(self.resize_size, Image.NEAREST)
-        if self.autoaug:
-            policy = ImageNetPolicy()
-            image = policy(image)
+        label = label.resize(self.resize_size, Image.NEAREST)
+        if not self.crop_first:
+            image = image.resize(self.resize_size, Image.BICUBIC)
+        if self.autoaug and not self.crop_first:
+            image = self.augment(image)
 
-        image, label = np.asarray(image, np.float32), np.asarray(label, np.uint8)
+        label = np.asarray(label, np.uint8)
 
         # re-assign labels to match the format of Cityscapes
-        label_copy = 255 * np.ones(label.shape, dtype=np.uint8)
-        for k, v in list(self.id_to_trainid.items()):
-            label_copy[label == k] = v
+        label_copy = map_labels(label, self.lut)
 
-        size = image.shape
-        image = image[:, :, ::-1]  # change to BGR
-        image -= self.mean
-        image = image.transpose((2, 0, 1))
-        x1 = random.randint(0, image.shape[1] - self.h)
-        y1 = random.randint(0, image.shape[2] - self.w)
-        image = image[:, x1:x1+self.h, y1:y1+self.w]
+        size = (self.resize_size[1], self.resize_size[0], 3)
+        x1 = random.randint(0, size[0] - self.h)
+        y1 = random.randint(0, size[1] - self.w)
+        if self.crop_first:
+            # only resample the source region under the crop
+            image = resize_crop(image, self.resize_size, x1, y1, self.h, self.w)
+            if self.autoaug:
+                image = self.augment(image)
+        else:
+            image = np.asarray(image, np.uint8)[x1:x1+self.h, y1:y1+self.w]
         label_copy = label_copy[x1:x1+self.h, y1:y1+self.w]
 
         if self.is_mirror and random.random() < 0.5:
-            image = np.flip(image, axis = 2)
+            image = np.flip(image, axis = 1)
             label_copy = np.flip(label_copy, axis = 1)
+
+        if not self.return_uint8:
+            image = np.asarray(image, np.float32)
+            image = image[:, :, ::-1]  # change to BGR
+            image -= self.mean
+            image = image.transpose((2, 0, 1))
         #print('Time used: {} sec'.format(time.time()-tt))
         return image.copy(), label_copy.copy(), np.array(size), name
 
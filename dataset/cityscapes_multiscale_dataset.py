@@ -0,0 +1,75 @@
+import os.path as osp
+import numpy as np
+from torch.utils import data
+from PIL import Image, ImageFile
+from utils.label_mapping import build_lut, map_labels
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+class cityscapesMultiScaleDataSet(data.Dataset):
+    """ Cityscapes test-time pyramid: every image is decoded once and resized to all scales.
+
+        Scale s resizes to (round(resize_size[0] * s), round(resize_size[1] * s)),
+        the same size a cityscapesDataSet built for that scale would use, and
+        only the requested scales are produced. With `with_label` the full
+        resolution train-id label is returned too, otherwise an empty array.
+        A `label_store` from dataset.gt_store replaces the label PNG decode.
+
+        Example:
+        >>> dst = cityscapesMultiScaleDataSet(root, list_path, scales=(1.0, 1.25), mean=IMG_MEAN)
+        >>> images, label, size, name = dst[0]  # images[i] is the float BGR CxHxW input of scales[i]
+    """
+    def __init__(self, root, list_path, scales=(1.0,), resize_size=(1024, 512), mean=(128, 128, 128), set='val', with_label=False, label_store=None):
+        self.root = root
+        self.list_path = list_path
+        self.scales = scales
+        self.resize_size = resize_size
+        self.mean = mean
+        self.set = set
+        self.with_label = with_label
+        self.label_store = label_store
+        self.id_to_trainid = {7: 0, 8: 1, 11: 2, 12: 3, 13: 4, 17: 5,
+                              19: 6, 20: 7, 21: 8, 22: 9, 23: 10, 24: 11, 25: 12,
+                              26: 13, 27: 14, 28: 15, 31: 16, 32: 17, 33: 18}
+        self.lut = build_lut(self.id_to_trainid)
+        self.img_ids = [i_id.strip() for i_id in open(list_path)]
+        self.files = []
+        for name in self.img_ids:
+            img_file = osp.join(self.root, "leftImg8bit/%s/%s" % (self.set, name))
+            label_name = name.replace('leftImg8bit', 'gtFine_labelIds')
+            label_file = osp.join(self.root, "gtFine/%s/%s" % (self.set, label_name))
+            self.files.append({
+                "img": img_file,
+                "label": label_file,
+                "label_name": label_name,
+                "name": name
+            })
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        datafiles = self.files[index]
+        name = datafiles["name"]
+
+        image = Image.open(datafiles["img"]).convert('RGB')
+        size = None
+        images = []
+        for scale in self.scales:
+            resized = image.resize((round(self.resize_size[0] * scale), round(self.resize_size[1] * scale)), Image.BICUBIC)
+            resized = np.asarray(resized, np.float32)
+            if size is None:
+                size = resized.shape
+            resized = resized[:, :, ::-1]  # change to BGR
+            resized -= self.mean
+            images.append(resized.transpose((2, 0, 1)).copy())
+
+        if self.with_label and self.label_store is not None:
+            label = np.array(self.label_store.get('label', datafiles["label_name"]))
+        elif self.with_label:
+            label = map_labels(np.asarray(Image.open(datafiles["label"]), np.uint8), self.lut)
+        else:
+            label = np.zeros((0,), np.uint8)
+
+        return images, label, np.array(size), name
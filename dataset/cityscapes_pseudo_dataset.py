@@ -10,12 +10,28 @@ import torch
 import torchvision
 from torch.utils import data
 from PIL import Image,ImageFile
-from dataset.autoaugment import ImageNetPolicy
+from dataset.list_dataset import ListDataSet
+from dataset.crop_sampler import ClassRichCropSampler, resize_crop
+from dataset.memmap_store import MemmapStore
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-class cityscapes_pseudo_DataSet(data.Dataset):
-    def __init__(self, root, list_path, max_iters=None, resize_size=(1024, 512), crop_size=(512, 1024), mean=(128, 128, 128), scale=False, mirror=True, ignore_label=255, set='val', autoaug=False, synthia=False, threshold = 1.0):
+class cityscapes_pseudo_DataSet(ListDataSet):
+    """ Cityscapes images with pseudo labels from generate_plabel_cityscapes.py.
+
+        Labels come from the PNG directories (pseudo/, pseudo_<threshold>/
+        or pseudo_SYNTHIA/), or with `pseudo_store` from the memory-mapped
+        store written by --store. The store keeps the uint8 confidence of
+        every pixel, so any `threshold` < 1.0 is applied here, setting less
+        confident pixels to ignore_label, instead of needing its own run.
+        An entry of `label_cache` (a SharedLabelCache refreshed during
+        training, see --online-label in train_ft_sr_multi.py) takes the place
+        of the offline label once it is valid.
+
+        Example:
+        >>> dst = cityscapes_pseudo_DataSet(root, list_path, set='train', pseudo_store='./data/Cityscapes/data/pseudo_store/train', threshold=0.8)
+    """
+    def __init__(self, root, list_path, max_iters=None, resize_size=(1024, 512), crop_size=(512, 1024), mean=(128, 128, 128), scale=False, mirror=True, ignore_label=255, set='val', autoaug=False, synthia=False, threshold = 1.0, return_uint8=False, crop_first=False, pseudo_store=None, label_cache=None):
         self.root = root
         self.list_path = list_path
         self.crop_size = crop_size
@@ -25,12 +41,16 @@ class cityscapes_pseudo_DataSet(data.Dataset):
         self.is_mirror = mirror
         self.resize_size = resize_size
         self.autoaug = autoaug
+        self.return_uint8 = return_uint8
+        self.crop_first = crop_first
+        self.threshold = threshold
+        self.pseudo_store = MemmapStore(pseudo_store) if pseudo_store else None
+        self.label_cache = label_cache
         self.h = crop_size[0]
         self.w = crop_size[1]
         # self.mean_bgr = np.array([104.00698793, 116.66876762, 122.67891434])
         self.img_ids = [i_id.strip() for i_id in open(list_path)]
-        if not max_iters==None:
-            self.img_ids = self.img_ids * int(np.ceil(float(max_iters) / len(self.img_ids)))
+        self.set_num_samples(max_iters)
         self.files = []
         self.set = set
         # for split in ["train", "trainval", "val"]:
@@ -53,30 +73,36 @@ class cityscapes_pseudo_DataSet(data.Dataset):
                 "name": name
             })
 
-    def __len__(self):
-        return len(self.files)
-
     def __getitem__(self, index):
-        datafiles = self.files[index]
+        datafiles = self.files[index % len(self.files)]
 
         image = Image.open(datafiles["img"]).convert('RGB')
-        label = Image.open(datafiles["label"])
         name = datafiles["name"]
+        cached = self.label_cache.get(index % len(self.files)) if self.label_cache is not None else None
+        if cached is not None:
+            label = Image.fromarray(cached)
+        elif self.pseudo_store is not None:
+            label = self.pseudo_store.get('label', name)
+            if self.threshold < 1.0:
+                conf = self.pseudo_store.get('conf', name)
+                label = np.where(conf < self.threshold * 255, self.ignore_label, label).astype(np.uint8)
+            label = Image.fromarray(np.ascontiguousarray(label))
+        else:
+            label = Image.open(datafiles["label"])
 
         # resize
         if self.scale:
             random_scale = 0.8 + random.random()*0.4 # 0.8 - 1.2
-            image = image.resize( ( round(self.resize_size[0] * random_scale), round(self.resize_size[1] * random_scale)) , Image.BICUBIC)
-            label = label.resize( ( round(self.resize_size[0] * random_scale), round(self.resize_size[1] * random_scale)) , Image.NEAREST)
+            resize_size = ( round(self.resize_size[0] * random_scale), round(self.resize_size[1] * random_scale))
         else:
-            image = image.resize( ( self.resize_size[0], self.resize_size[1] ) , Image.BICUBIC)
-            label = label.resize( ( self.resize_size[0], self.resize_size[1] ) , Image.NEAREST)
+            resize_size = ( self.resize_size[0], self.resize_size[1] )
+        label = label.resize(resize_size, Image.NEAREST)
+        if not self.crop_first:
+            image = image.resize(resize_size, Image.BICUBIC)
 
-        if self.autoaug:
-            policy = ImageNetPolicy()
-            image = policy(image)
+        if self.autoaug and not self.crop_first:
+            image = self.augment(image)
 
-        image = np.asarray(image, np.float32)
         label = np.asarray(label, np.uint8)
 
         # re-assign labels to match the format of Cityscapes
@@ -85,28 +111,27 @@ class cityscapes_pseudo_DataSet(data.Dataset):
         #    label_copy[label == k] = v
         label_copy = label
 
-        size = image.shape
-        image = image[:, :, ::-1]  # change to BGR
-        image -= self.mean
-        image = image.transpose((2, 0, 1))
-        #print(image.shape, label.shape)
-        for i in range(10): #find hard samples
-            x1 = random.randint(0, image.shape[1] - self.h)
-            y1 = random.randint(0, image.shape[2] - self.w)
-            tmp_label_copy = label_copy[x1:x1+self.h, y1:y1+self.w]
-            tmp_image = image[:, x1:x1+self.h, y1:y1+self.w]
-            u =  np.unique(tmp_label_copy)
-            if len(u) > 10:
-                break
-            #else:
-                #print('Cityscape-Pseudo: Too young too naive for %d times!'%i)
-        image = tmp_image
-        label_copy = tmp_label_copy
+        size = (resize_size[1], resize_size[0], 3)
+        x1, y1 = ClassRichCropSampler(label_copy, self.h, self.w).sample() #find hard samples
+        if self.crop_first:
+            # the label is resized in full for the sampler, the image only under the crop
+            image = resize_crop(image, resize_size, x1, y1, self.h, self.w)
+            if self.autoaug:
+                image = self.augment(image)
+        else:
+            image = np.asarray(image, np.uint8)[x1:x1+self.h, y1:y1+self.w]
+        label_copy = label_copy[x1:x1+self.h, y1:y1+self.w]
 
         if self.is_mirror and random.random() < 0.5:
-            image = np.flip(image, axis = 2)
+            image = np.flip(image, axis = 1)
             label_copy = np.flip(label_copy, axis = 1)
 
+        if not self.return_uint8:
+            image = np.asarray(image, np.float32)
+            image = image[:, :, ::-1]  # change to BGR
+            image -= self.mean
+            image = image.transpose((2, 0, 1))
+
         return image.copy(), label_copy.copy(), np.array(size), name
 
 
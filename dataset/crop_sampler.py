@@ -0,0 +1,75 @@
+import numpy as np
+import random
+from PIL import Image
+
+
+class ClassRichCropSampler(object):
+    """ Pick a crop offset that contains more than `min_classes` label values.
+
+        Same sampling as the retry loop the datasets used before: up to
+        `max_tries` uniform offsets drawn with `random.randint`, the first
+        crop with more than `min_classes` distinct values wins, otherwise the
+        last one is kept. Instead of np.unique on every candidate crop, each
+        try is first answered from per-tile class bitmasks of a subsampled
+        label (a lower bound on the classes in the crop); only crops the
+        bound cannot accept are counted exactly.
+
+        Example:
+        >>> x1, y1 = ClassRichCropSampler(label, 512, 1024).sample()
+        >>> label = label[x1:x1+512, y1:y1+1024]
+    """
+    def __init__(self, label, crop_h, crop_w, min_classes=10, max_tries=10, tile=16, stride=4):
+        self.label = label
+        self.h = crop_h
+        self.w = crop_w
+        self.min_classes = min_classes
+        self.max_tries = max_tries
+        self.tile = tile
+
+        sub = label[::stride, ::stride]
+        values = np.flatnonzero(np.bincount(sub.ravel(), minlength=256))
+        bits = np.zeros(max(256, values[-1] + 1), dtype=np.uint64)
+        if len(values) <= 64:
+            bits[values] = np.left_shift(np.uint64(1), np.arange(len(values), dtype=np.uint64))
+        n = tile // stride
+        th, tw = sub.shape[0] // n, sub.shape[1] // n
+        masks = bits[sub[:th * n, :tw * n]].reshape(th, n, tw, n)
+        self.masks = np.bitwise_or.reduce(np.bitwise_or.reduce(masks, axis=3), axis=1)
+
+    def lower_bound(self, x1, y1):
+        """Number of classes guaranteed to be inside the crop at (x1, y1)."""
+        t = self.tile
+        r0, r1 = -(-x1 // t), min((x1 + self.h) // t, self.masks.shape[0])
+        c0, c1 = -(-y1 // t), min((y1 + self.w) // t, self.masks.shape[1])
+        if r0 >= r1 or c0 >= c1:
+            return 0
+        return bin(int(np.bitwise_or.reduce(self.masks[r0:r1, c0:c1], axis=None))).count('1')
+
+    def num_classes(self, x1, y1):
+        crop = self.label[x1:x1 + self.h, y1:y1 + self.w]
+        return np.count_nonzero(np.bincount(crop.ravel(), minlength=256))
+
+    def sample(self):
+        for i in range(self.max_tries):
+            x1 = random.randint(0, self.label.shape[0] - self.h)
+            y1 = random.randint(0, self.label.shape[1] - self.w)
+            if self.lower_bound(x1, y1) > self.min_classes or self.num_classes(x1, y1) > self.min_classes:
+                break
+        return x1, y1
+
+
+def resize_crop(image, resize_size, x1, y1, crop_h, crop_w, resample=Image.BICUBIC):
+    """ Return image.resize(resize_size)[x1:x1+crop_h, y1:y1+crop_w] as a uint8 array.
+
+        Only the source region under the crop is resampled (PIL resize with
+        `box`), so the cost scales with the crop instead of the full frame.
+        The result matches resize-then-crop up to +-1 rounding.
+    """
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(np.asarray(image))
+    if tuple(image.size) == tuple(resize_size):
+        return np.asarray(image, np.uint8)[x1:x1 + crop_h, y1:y1 + crop_w]
+    sx = float(image.size[0]) / resize_size[0]
+    sy = float(image.size[1]) / resize_size[1]
+    box = (y1 * sx, x1 * sy, (y1 + crop_w) * sx, (x1 + crop_h) * sy)
+    return np.asarray(image.resize((crop_w, crop_h), resample, box=box), np.uint8)
@@ -0,0 +1,312 @@
+from PIL import Image, ImageEnhance
+import numpy as np
+import os
+import random
+import time
+import torch
+import torch.nn.functional as F
+from dataset.autoaugment import ImageNetPolicy
+
+# ops that draw a random sign for their enhance factor, in the order PIL does
+SIGNED_OPS = ('color', 'contrast', 'sharpness', 'brightness')
+POINTWISE_OPS = ('solarize', 'posterize', 'invert', 'equalize', 'autocontrast') + SIGNED_OPS
+
+_IDENTITY = np.arange(256)
+
+
+def _equalize_lut(hist, xp=np):
+    # ImageOps.equalize: step = (total - count of the last non-empty bin) // 255,
+    # lut[i] = (step // 2 + sum(hist[:i])) // step, identity when step is 0
+    if xp is torch:
+        last = 255 - torch.argmax((torch.flip(hist, [-1]) > 0).int(), -1)
+        last_count = hist.gather(-1, last.unsqueeze(-1)).squeeze(-1)
+        step = (hist.sum(-1) - last_count) // 255
+        cum = torch.cumsum(hist, -1) - hist
+        lut = (step.unsqueeze(-1) // 2 + cum) // step.clamp(min=1).unsqueeze(-1)
+        identity = torch.arange(256, device=hist.device).expand_as(lut)
+        return torch.where(step.unsqueeze(-1) > 0, lut.clamp(max=255), identity)
+    last = 255 - np.argmax(hist[..., ::-1] > 0, -1)
+    last_count = np.take_along_axis(hist, last[..., None], -1)[..., 0]
+    step = (hist.sum(-1) - last_count) // 255
+    cum = np.cumsum(hist, -1) - hist
+    lut = (step[..., None] // 2 + cum) // np.maximum(step, 1)[..., None]
+    return np.where(step[..., None] > 0, np.minimum(lut, 255), _IDENTITY)
+
+
+def _autocontrast_lut(lo, hi, xp=np):
+    # ImageOps.autocontrast(cutoff=0): stretch [lo, hi] to [0, 255]
+    if xp is torch:
+        lo, hi = lo.double(), hi.double()
+        scale = 255.0 / (hi - lo).clamp(min=1)
+        identity = torch.arange(256, device=lo.device, dtype=torch.float64)
+        lut = (identity * scale.unsqueeze(-1) - (lo * scale).unsqueeze(-1)).trunc().clamp(0, 255)
+        return torch.where((hi > lo).unsqueeze(-1), lut, identity).long()
+    lo, hi = lo.astype(np.float64), hi.astype(np.float64)
+    scale = 255.0 / np.maximum(hi - lo, 1)
+    lut = np.clip(np.trunc(_IDENTITY * scale[..., None] - (lo * scale)[..., None]), 0, 255)
+    return np.where((hi > lo)[..., None], lut, _IDENTITY)
+
+
+def _blend(degenerate, img, factor):
+    # Image.blend: float32 interpolation, clipped and truncated to uint8
+    degenerate = np.float32(degenerate)
+    out = np.float32(factor) * (np.float32(img) - degenerate) + degenerate
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+
+class _Pipeline(object):
+    """Chains point-wise ops into a single per-channel LUT, applied on flush()."""
+    def __init__(self, img):
+        self.img = img
+        self.lut = None
+        self.hist = None
+
+    def histogram(self):
+        if self.hist is None:
+            hist = np.asarray(Image.fromarray(self.img).histogram(), np.int64).reshape(3, 256)
+            self.hist = hist if self.lut is None else self.remap(hist, self.lut)
+        return self.hist
+
+    @staticmethod
+    def remap(hist, lut):
+        return np.stack([np.bincount(lut[c], weights=hist[c], minlength=256) for c in range(3)]).astype(np.int64)
+
+    def point(self, lut):
+        lut = np.broadcast_to(lut, (3, 256)).astype(np.uint8)
+        if self.hist is not None:
+            self.hist = self.remap(self.hist, lut)
+        self.lut = lut if self.lut is None else np.take_along_axis(lut, self.lut.astype(np.intp), 1)
+
+    def flush(self):
+        if self.lut is not None:
+            # Image.point is the fastest per-channel table lookup available
+            self.img = np.asarray(Image.fromarray(self.img).point(self.lut.ravel().tolist()))
+            self.lut = None
+        return self.img
+
+    def apply(self, name, magnitude):
+        if name == 'solarize':
+            self.point(np.where(_IDENTITY < magnitude, _IDENTITY, 255 - _IDENTITY))
+        elif name == 'posterize':
+            self.point(_IDENTITY & ~(2 ** (8 - int(magnitude)) - 1))
+        elif name == 'invert':
+            self.point(255 - _IDENTITY)
+        elif name == 'brightness':
+            self.point(_blend(0, _IDENTITY, magnitude))
+        elif name == 'equalize':
+            self.point(_equalize_lut(self.histogram()))
+        elif name == 'autocontrast':
+            nonzero = self.histogram() > 0
+            self.point(_autocontrast_lut(np.argmax(nonzero, 1), 255 - np.argmax(nonzero[:, ::-1], 1)))
+        elif name == 'contrast':
+            hist = Image.fromarray(self.flush()).convert('L').histogram()
+            mean = int(np.dot(hist, _IDENTITY) / float(sum(hist)) + 0.5)
+            self.point(_blend(mean, _IDENTITY, magnitude))
+        elif name in ('color', 'sharpness'):
+            # not per-channel LUTs, PIL's C blend is faster than anything numpy does here
+            enhance = ImageEnhance.Color if name == 'color' else ImageEnhance.Sharpness
+            self.img = np.asarray(enhance(Image.fromarray(self.flush())).enhance(magnitude))
+            self.hist = None
+        else:
+            raise ValueError('%s is not a point-wise op.' % name)
+
+
+class FastPolicy(object):
+    """ Array version of an AutoAugment policy from dataset/autoaugment.py.
+
+        The sub-policies are read once from the PIL policy, so build one per
+        worker (not per sample). Works on uint8 HxWx3 arrays: consecutive
+        LUT ops (solarize, posterize, invert, equalize, autocontrast,
+        brightness, contrast) are folded into one per-channel LUT in numpy,
+        with the equalize/autocontrast statistics read from a remapped
+        histogram, so a sub-policy costs one histogram and one table lookup
+        pass instead of a PIL round-trip per op. Color, sharpness and the
+        geometric ops use the PIL kernels. Random draws happen in the same
+        order as the PIL policy, so both give the same result for one seed.
+
+        Example:
+        >>> policy = FastPolicy()
+        >>> image = policy(np.asarray(image, np.uint8))
+    """
+    def __init__(self, policy=None):
+        if policy is None:
+            policy = ImageNetPolicy()
+        self.policies = [((sub.p1, sub.names[0], sub.magnitude1, sub.operation1),
+                          (sub.p2, sub.names[1], sub.magnitude2, sub.operation2)) for sub in policy.policies]
+
+    def __call__(self, img):
+        pipeline = _Pipeline(np.asarray(img, np.uint8))
+        for p, name, magnitude, operation in self.policies[random.randint(0, len(self.policies) - 1)]:
+            if random.random() < p:
+                if name in SIGNED_OPS:
+                    pipeline.apply(name, 1 + magnitude * random.choice([-1, 1]))
+                elif name in POINTWISE_OPS:
+                    pipeline.apply(name, magnitude)
+                else:
+                    pipeline.img = np.asarray(operation(Image.fromarray(pipeline.flush()), magnitude), np.uint8)
+                    pipeline.hist = None
+        return pipeline.flush()
+
+    def __repr__(self):
+        return "Fast AutoAugment Policy"
+
+
+class BatchPolicy(object):
+    """ AutoAugment on a whole NxHxWx3 uint8 CUDA tensor.
+
+        Every sample draws its own sub-policy exactly like FastPolicy; the
+        samples that apply the same op in the same stage are then processed
+        together. Only point-wise ops are supported. On CPU it is several
+        times slower than FastPolicy per sample, so CPU tensors are refused.
+
+        Example:
+        >>> policy = BatchPolicy()
+        >>> images = policy(images.cuda())  # uint8 NHWC, before normalize_batch
+    """
+    def __init__(self, policy=None):
+        if policy is None:
+            policy = ImageNetPolicy()
+        for sub in policy.policies:
+            for name in sub.names:
+                if name not in POINTWISE_OPS:
+                    raise ValueError('BatchPolicy only supports point-wise ops, got %s.' % name)
+        self.policies = [((sub.p1, sub.names[0], sub.magnitude1), (sub.p2, sub.names[1], sub.magnitude2))
+                         for sub in policy.policies]
+
+    def draw(self, n):
+        """Per stage, {op: ([sample indices], [magnitudes or enhance factors])}."""
+        stages = [{}, {}]
+        for i in range(n):
+            ops = self.policies[random.randint(0, len(self.policies) - 1)]
+            for stage, (p, name, magnitude) in zip(stages, ops):
+                if random.random() < p:
+                    if name in SIGNED_OPS:
+                        magnitude = 1 + magnitude * random.choice([-1, 1])
+                    idx, mags = stage.setdefault(name, ([], []))
+                    idx.append(i)
+                    mags.append(float(magnitude))
+        return stages
+
+    def __call__(self, images):
+        if not images.is_cuda:
+            raise ValueError('BatchPolicy only runs on CUDA tensors, use FastPolicy in the loader workers on CPU.')
+        images = images.clone()
+        for stage in self.draw(images.size(0)):
+            for name, (idx, mags) in stage.items():
+                idx = torch.tensor(idx, device=images.device)
+                mags = torch.tensor(mags, device=images.device)
+                images[idx] = self.apply(images[idx], name, mags)
+        return images
+
+    @staticmethod
+    def apply(x, name, mags):
+        n = x.size(0)
+        if name == 'solarize':
+            return torch.where(x.float() < mags.view(-1, 1, 1, 1), x, 255 - x)
+        if name == 'posterize':
+            mask = (255 - (2 ** (8 - mags.long()) - 1)).to(torch.uint8)
+            return x & mask.view(-1, 1, 1, 1)
+        if name == 'invert':
+            return 255 - x
+        if name in ('equalize', 'autocontrast'):
+            offset = (torch.arange(n * 3, device=x.device) * 256).view(n, 1, 1, 3)
+            index = x.long() + offset
+            if name == 'equalize':
+                hist = torch.bincount(index.view(-1), minlength=n * 768).view(n, 3, 256)
+                lut = _equalize_lut(hist, xp=torch)
+            else:
+                lut = _autocontrast_lut(x.amin(dim=(1, 2)), x.amax(dim=(1, 2)), xp=torch)
+            return lut.view(-1)[index].to(torch.uint8)
+
+        if name == 'color':
+            degenerate = BatchPolicy.gray(x).unsqueeze(-1).float()
+        elif name == 'contrast':
+            gray = BatchPolicy.gray(x).view(n, -1)
+            count = gray.size(1)
+            degenerate = ((2 * gray.sum(1) + count) // (2 * count)).float().view(-1, 1, 1, 1)
+        elif name == 'sharpness':
+            degenerate = BatchPolicy.smooth(x)
+        elif name == 'brightness':
+            degenerate = torch.zeros_like(x, dtype=torch.float32)
+        else:
+            raise ValueError('%s is not a point-wise op.' % name)
+        out = mags.view(-1, 1, 1, 1) * (x.float() - degenerate) + degenerate
+        return out.clamp(0, 255).to(torch.uint8)
+
+    @staticmethod
+    def gray(x):
+        x = x.int()
+        return (x[..., 0] * 19595 + x[..., 1] * 38470 + x[..., 2] * 7471 + 0x8000) >> 16
+
+    @staticmethod
+    def smooth(x):
+        kernel = torch.ones(3, 1, 3, 3, device=x.device)
+        kernel[:, :, 1, 1] = 5
+        nchw = x.permute(0, 3, 1, 2).float()
+        inner = torch.floor(F.conv2d(nchw, kernel, groups=3) / 13 + 0.5)
+        out = nchw.clone()
+        out[:, :, 1:-1, 1:-1] = inner
+        return out.permute(0, 2, 3, 1)
+
+
+def load_crops(root, list_path, subdir, resize_size, crop_size, num_images, seed=1234):
+    """The first num_images of a dataset list, resized and randomly cropped (w, h) as the trainers do."""
+    rng = random.Random(seed)
+    names = [i_id.strip() for i_id in open(list_path)][:num_images]
+    crops = []
+    for name in names:
+        path = os.path.join(root, subdir, name)
+        if not os.path.isfile(path):
+            raise IOError('%s is missing, the benchmark needs the real images of %s.' % (path, list_path))
+        image = Image.open(path).convert('RGB').resize(resize_size, Image.BICUBIC)
+        x = rng.randint(0, resize_size[0] - crop_size[0])
+        y = rng.randint(0, resize_size[1] - crop_size[1])
+        crops.append(np.asarray(image.crop((x, y, x + crop_size[0], y + crop_size[1])), np.uint8))
+    return crops
+
+
+def benchmark(name, images, seed=1234):
+    random.seed(seed)
+    tt = time.time()
+    reference = [np.asarray(ImageNetPolicy()(Image.fromarray(img)), np.uint8) for img in images]
+    pil_time = (time.time() - tt) / len(images)
+
+    random.seed(seed)
+    tt = time.time()
+    policy = FastPolicy()
+    fast = [policy(img) for img in images]
+    fast_time = (time.time() - tt) / len(images)
+    same = np.mean([np.array_equal(a, b) for a, b in zip(reference, fast)])
+
+    h, w = images[0].shape[:2]
+    print('%s, %d %dx%d crops: PIL policy %.2f ms/img, FastPolicy %.2f ms/img (%.1fx), identical %.0f%%' % (
+        name, len(images), w, h, pil_time * 1000, fast_time * 1000, pil_time / fast_time, same * 100))
+
+    if not torch.cuda.is_available():
+        print('%s: no CUDA device, BatchPolicy skipped (CPU tensors are not supported)' % name)
+        return
+    batch = torch.from_numpy(np.stack(images)).cuda()
+    random.seed(seed)
+    torch.cuda.synchronize()
+    tt = time.time()
+    batched = BatchPolicy()(batch).cpu().numpy()
+    batch_time = (time.time() - tt) / len(images)
+    same_batch = np.mean([np.array_equal(a, b) for a, b in zip(reference, batched)])
+    print('%s: BatchPolicy on cuda %.2f ms/img (%.1fx), identical %.0f%%' % (
+        name, batch_time * 1000, pil_time / batch_time, same_batch * 100))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="AutoAugment engines on real training crops")
+    parser.add_argument("--gta5-dir", type=str, default='./data/GTA5')
+    parser.add_argument("--gta5-list", type=str, default='./dataset/gta5_list/train.txt')
+    parser.add_argument("--cityscapes-dir", type=str, default='./data/Cityscapes/data')
+    parser.add_argument("--cityscapes-list", type=str, default='./dataset/cityscapes_list/train.txt')
+    parser.add_argument("--crop-size", type=str, default='640,360', help="Comma-separated width,height, as the trainers.")
+    parser.add_argument("--num-images", type=int, default=32)
+    args = parser.parse_args()
+    crop_size = tuple(map(int, args.crop_size.split(',')))
+    benchmark('GTA5', load_crops(args.gta5_dir, args.gta5_list, 'images', (1280, 720), crop_size, args.num_images))
+    benchmark('Cityscapes', load_crops(args.cityscapes_dir, args.cityscapes_list, 'leftImg8bit/train', (1024, 512),
+                                       crop_size, args.num_images))
@@ -0,0 +1,65 @@
+import os
+import os.path as osp
+import shutil
+import numpy as np
+import time
+from multiprocessing import Pool
+from PIL import Image
+from dataset.memmap_store import MemmapStore, MemmapStoreWriter
+from utils.label_mapping import map_labels
+
+NUM_WORKERS = 8
+
+
+def file_signature(paths):
+    """(size, mtime_ns) of every file, used to tell whether a cache is stale."""
+    signature = []
+    for path in paths:
+        st = os.stat(path)
+        signature.append([st.st_size, st.st_mtime_ns])
+    return signature
+
+
+def _load(job):
+    label_file, lut = job
+    label = np.asarray(Image.open(label_file))
+    if len(label.shape) == 3:
+        label = label[:,:,0]
+    return map_labels(label, lut)
+
+
+def open_gt_store(cache_dir, gt_dir, names, lut, num_workers=NUM_WORKERS):
+    """ Return a MemmapStore with the train-id ground truth of `names`, building it if needed.
+
+        names are the label paths relative to gt_dir (as in label.txt) and are
+        the keys of the store, the 'label' field holds lut-remapped uint8
+        maps. The cache is reused while the list, the lut and the size and
+        mtime of every source PNG are unchanged, otherwise it is rebuilt.
+
+        Example:
+        >>> store = open_gt_store('./data/Cityscapes/gt_cache/val', gt_dir, names, lut)
+        >>> label = store.get('label', names[0])
+    """
+    names = list(names)
+    gt_files = [osp.join(gt_dir, name) for name in names]
+    meta = {'signature': file_signature(gt_files), 'lut': np.asarray(lut).tolist()}
+
+    if MemmapStore.exists(cache_dir):
+        store = MemmapStore(cache_dir)
+        if store.names == names and store.meta == meta:
+            return store
+        print('Ground-truth cache %s is stale, rebuilding' % cache_dir)
+        shutil.rmtree(cache_dir)
+
+    shape = _load((gt_files[0], lut)).shape
+    writer = MemmapStoreWriter(cache_dir, names, {'label': (shape, 'uint8')}, meta=meta)
+    tt = time.time()
+    with Pool(num_workers) as p:
+        for index, label in enumerate(p.imap(_load, [(f, lut) for f in gt_files], chunksize=4)):
+            if label.shape != shape:
+                raise ValueError('%s is %s, the ground-truth cache needs every label to be %s.'
+                                 % (gt_files[index], label.shape, shape))
+            writer.write(index, label=label)
+    writer.close()
+    print('Ground-truth cache of %d labels written to %s in %.1f sec' % (len(names), cache_dir, time.time() - tt))
+    return MemmapStore(cache_dir)
@@ -8,13 +8,16 @@ import torch
 import torchvision
 from torch.utils import data
 from PIL import Image, ImageFile
-from dataset.autoaugment import ImageNetPolicy
+from dataset.list_dataset import ListDataSet
+from dataset.crop_sampler import ClassRichCropSampler, resize_crop
+from utils.label_mapping import build_lut, map_labels
+from dataset.memmap_store import MemmapStore
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 
-class GTA5DataSet(data.Dataset):
-    def __init__(self, root, list_path, max_iters=None, resize_size=(1024, 512), crop_size=(512, 1024), mean=(128, 128, 128), scale=False, mirror=True, ignore_label=255, autoaug = False):
+class GTA5DataSet(ListDataSet):
+    def __init__(self, root, list_path, max_iters=None, resize_size=(1024, 512), crop_size=(512, 1024), mean=(128, 128, 128), scale=False, mirror=True, ignore_label=255, autoaug = False, cache_dir=None, return_uint8=False, crop_first=False):
         self.root = root
         self.list_path = list_path
         self.crop_size = crop_size
@@ -24,17 +27,19 @@ class GTA5DataSet(data.Dataset):
         self.is_mirror = mirror
         self.resize_size = resize_size
         self.autoaug = autoaug
+        self.return_uint8 = return_uint8
+        self.crop_first = crop_first
         self.h = crop_size[0]
         self.w = crop_size[1]
         # self.mean_bgr = np.array([104.00698793, 116.66876762, 122.67891434])
         self.img_ids = [i_id.strip() for i_id in open(list_path)]
-        if not max_iters==None:
-            self.img_ids = self.img_ids * int(np.ceil(float(max_iters) / len(self.img_ids)))
+        self.set_num_samples(max_iters)
         self.files = []
 
         self.id_to_trainid = {7: 0, 8: 1, 11: 2, 12: 3, 13: 4, 17: 5,
                               19: 6, 20: 7, 21: 8, 22: 9, 23: 10, 24: 11, 25: 12,
                               26: 13, 27: 14, 28: 15, 31: 16, 32: 17, 33: 18}
+        self.lut = build_lut(self.id_to_trainid)
 
         # for split in ["train", "trainval", "val"]:
         for name in self.img_ids:
@@ -46,61 +51,71 @@ class GTA5DataSet(data.Dataset):
                 "name": name
             })
 
-    def __len__(self):
-        return len(self.files)
+        # pre-resized images and remapped labels written by compile_gta5_cache.py
+        self.store = None
+        if cache_dir is not None:
+            self.store = MemmapStore(cache_dir)
+            if tuple(self.store.meta['resize_size']) != tuple(self.resize_size):
+                raise ValueError('Cache %s was compiled for size %s, but resize_size is %s.'
+                                 % (cache_dir, self.store.meta['resize_size'], self.resize_size))
 
 
     def __getitem__(self, index):
-        datafiles = self.files[index]
-
-        image = Image.open(datafiles["img"]).convert('RGB')
-        label = Image.open(datafiles["label"])
+        datafiles = self.files[index % len(self.files)]
         name = datafiles["name"]
 
-        # resize
-        if self.scale:
-            random_scale = 0.8 + random.random()*0.4 # 0.8 - 1.2
-            image = image.resize( ( round(self.resize_size[0] * random_scale), round(self.resize_size[1] * random_scale)) , Image.BICUBIC)
-            label = label.resize( ( round(self.resize_size[0] * random_scale), round(self.resize_size[1] * random_scale)) , Image.NEAREST)
-        else: 
-            image = image.resize( ( self.resize_size[0], self.resize_size[1] ) , Image.BICUBIC)
-            label = label.resize( ( self.resize_size[0], self.resize_size[1] ) , Image.NEAREST)
-
-        if self.autoaug:
-            policy = ImageNetPolicy()
-            image = policy(image)
-
-        image = np.asarray(image, np.float32)
-        label = np.asarray(label, np.uint8)
-
-        # re-assign labels to match the format of Cityscapes
-        label_copy = 255 * np.ones(label.shape, dtype=np.uint8)
-        for k, v in list(self.id_to_trainid.items()):
-            label_copy[label == k] = v
-
-        size = image.shape
-        image = image[:, :, ::-1]  # change to BGR
-        image -= self.mean
-        image = image.transpose((2, 0, 1))
-        print(image.shape, label.shape)
-        for i in range(10): #find hard samples
-            x1 = random.randint(0, image.shape[1] - self.h)
-            y1 = random.randint(0, image.shape[2] - self.w)
-            tmp_label_copy = label_copy[x1:x1+self.h, y1:y1+self.w]
-            tmp_image = image[:, x1:x1+self.h, y1:y1+self.w]
-            u =  np.unique(tmp_label_copy)
-            if len(u) > 10:
-                break
+        if self.store is not None:
+            # the cache already holds resize_size, only the random scale is left
+            image = self.store.get('image', name)
+            label_copy = self.store.get('label', name)
+            resize_size = self.resize_size
+            if self.scale:
+                random_scale = 0.8 + random.random()*0.4 # 0.8 - 1.2
+                resize_size = ( round(self.resize_size[0] * random_scale), round(self.resize_size[1] * random_scale))
+                label_copy = np.asarray(Image.fromarray(label_copy).resize(resize_size, Image.NEAREST))
+                if not self.crop_first:
+                    image = Image.fromarray(image).resize(resize_size, Image.BICUBIC)
+        else:
+            image = Image.open(datafiles["img"]).convert('RGB')
+            label = Image.open(datafiles["label"])
+
+            # resize
+            if self.scale:
+                random_scale = 0.8 + random.random()*0.4 # 0.8 - 1.2
+                resize_size = ( round(self.resize_size[0] * random_scale), round(self.resize_size[1] * random_scale))
             else:
-                print('GTA5: Too young too naive for %d times!'%i)
-
-        image = tmp_image
-        label_copy = tmp_label_copy
+                resize_size = ( self.resize_size[0], self.resize_size[1] )
+            label = label.resize(resize_size, Image.NEAREST)
+            if not self.crop_first:
+                image = image.resize(resize_size, Image.BICUBIC)
+
+            # re-assign labels to match the format of Cityscapes
+            label_copy = map_labels(np.asarray(label, np.uint8), self.lut)
+
+        if self.autoaug and not self.crop_first:
+            image = self.augment(image)
+
+        size = (resize_size[1], resize_size[0], 3)
+        x1, y1 = ClassRichCropSampler(label_copy, self.h, self.w).sample() #find hard samples
+        if self.crop_first:
+            # the label is resized in full for the sampler, the image only under the crop
+            image = resize_crop(image, resize_size, x1, y1, self.h, self.w)
+            if self.autoaug:
+                image = self.augment(image)
+        else:
+            image = np.asarray(image, np.uint8)[x1:x1+self.h, y1:y1+self.w]
+        label_copy = label_copy[x1:x1+self.h, y1:y1+self.w]
 
         if self.is_mirror and random.random() < 0.5:
-            image = np.flip(image, axis = 2)
+            image = np.flip(image, axis = 1)
             label_copy = np.flip(label_copy, axis = 1)
 
+        if not self.return_uint8:
+            image = np.asarray(image, np.float32)
+            image = image[:, :, ::-1]  # change to BGR
+            image -= self.mean
+            image = image.transpose((2, 0, 1))
+
         return image.copy(), label_copy.copy(), np.array(size), name
 
 
@@ -0,0 +1,55 @@
+import time
+import torch
+
+
+class SharedLabelCache(object):
+    """ Pseudo labels in shared memory, written by the training process and read by DataLoader workers.
+
+        `labels` is a (num_images, h, w) uint8 tensor and `valid` marks the
+        entries filled in so far. Both live in shared memory from the start,
+        so labels put() after the workers were forked are visible to them
+        without restarting the loader. Index i is the i-th file of the
+        dataset reading the cache.
+
+        Writers and readers take no lock. Instead, put() bumps a per-index
+        generation counter before and after the write (odd while it is
+        writing). get() copies the label and retries while the counter is
+        odd or changed during the copy, so a worker never sees half of one
+        round and half of the next. The copy also keeps the returned array
+        independent of later writes.
+
+        Example:
+        >>> cache = SharedLabelCache(len(trainset.files), size=(512, 1024))
+        >>> trainset.label_cache = cache  # before the DataLoader starts its workers
+        >>> cache.put(0, pred)
+    """
+    def __init__(self, num_images, size=(512, 1024)):
+        self.size = tuple(size)
+        self.labels = torch.full((num_images,) + self.size, 255, dtype=torch.uint8).share_memory_()
+        self.valid = torch.zeros(num_images, dtype=torch.uint8).share_memory_()
+        self.generation = torch.zeros(num_images, dtype=torch.int64).share_memory_()
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    def put(self, index, label):
+        self.generation[index] += 1
+        self.labels[index].copy_(label)
+        self.generation[index] += 1
+        self.valid[index] = 1
+
+    def get(self, index):
+        """A copy of the cached label as a numpy array, None while the image has not been labeled."""
+        if not self.valid[index]:
+            return None
+        while True:
+            generation = int(self.generation[index])
+            if generation % 2 == 1:
+                time.sleep(0.001)
+                continue
+            label = self.labels[index].numpy().copy()
+            if int(self.generation[index]) == generation:
+                return label
+
+    def num_valid(self):
+        return int(self.valid.sum())
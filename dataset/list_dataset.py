@@ -0,0 +1,33 @@
+import numpy as np
+from torch.utils import data
+from dataset.fast_autoaugment import FastPolicy
+
+
+class ListDataSet(data.Dataset):
+    """ Shared parts of the training datasets reading an image list.
+
+        max_iters only stretches __len__; self.files stays one entry per
+        image and __getitem__ reads self.files[index % len(self.files)], so
+        the samplers see every image once per epoch. augment() builds the
+        FastPolicy lazily, once per worker.
+
+        Example:
+        >>> class GTA5DataSet(ListDataSet):
+        >>>     def __init__(self, root, list_path, max_iters=None, ...):
+        >>>         self.img_ids = [i_id.strip() for i_id in open(list_path)]
+        >>>         self.set_num_samples(max_iters)
+    """
+    policy = None
+
+    def set_num_samples(self, max_iters):
+        self.num_samples = len(self.img_ids)
+        if max_iters is not None:
+            self.num_samples = len(self.img_ids) * int(np.ceil(float(max_iters) / len(self.img_ids)))
+
+    def __len__(self):
+        return self.num_samples
+
+    def augment(self, image):
+        if self.policy is None:
+            self.policy = FastPolicy()
+        return self.policy(image)
@@ -0,0 +1,112 @@
+import os
+import os.path as osp
+import json
+import numpy as np
+
+INDEX_FILE = 'index.json'
+
+
+class MemmapStoreWriter(object):
+    """ Write fixed-shape per-sample arrays into memory-mapped .npy shards.
+
+        Every field is stored in its own set of shard files
+        (<field>_<shard>.npy), each holding `shard_size` samples. The index
+        is written by close(), so a store without index.json is incomplete.
+
+        Example:
+        >>> writer = MemmapStoreWriter('./cache', names, {'label': ((720, 1280), 'uint8')})
+        >>> writer.write(0, label=label)
+        >>> writer.close()
+    """
+    def __init__(self, root, names, fields, shard_size=1000, meta=None):
+        self.root = root
+        self.names = list(names)
+        self.fields = dict((k, (tuple(shape), np.dtype(dtype).str)) for k, (shape, dtype) in fields.items())
+        self.shard_size = shard_size
+        self.meta = meta if meta is not None else {}
+        self.num_shards = int(np.ceil(float(len(self.names)) / shard_size))
+        if not osp.exists(root):
+            os.makedirs(root)
+        self.shards = {}
+        for field, (shape, dtype) in self.fields.items():
+            self.shards[field] = []
+            for s in range(self.num_shards):
+                n = min(shard_size, len(self.names) - s * shard_size)
+                path = osp.join(root, '%s_%04d.npy' % (field, s))
+                if osp.exists(path):
+                    shard = np.load(path, mmap_mode='r+')
+                    if shard.shape != (n,) + shape or shard.dtype != np.dtype(dtype):
+                        raise ValueError('Existing shard %s does not match the requested layout.' % path)
+                else:
+                    shard = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n,) + shape)
+                self.shards[field].append(shard)
+
+    def write(self, index, **arrays):
+        shard, offset = divmod(index, self.shard_size)
+        for field, array in arrays.items():
+            self.shards[field][shard][offset] = array
+
+    def flush(self):
+        for shards in self.shards.values():
+            for shard in shards:
+                shard.flush()
+
+    def close(self):
+        self.flush()
+        index = {
+            'names': self.names,
+            'fields': dict((k, {'shape': list(shape), 'dtype': dtype}) for k, (shape, dtype) in self.fields.items()),
+            'shard_size': self.shard_size,
+            'num_shards': self.num_shards,
+            'meta': self.meta,
+        }
+        with open(osp.join(self.root, INDEX_FILE), 'w') as fp:
+            json.dump(index, fp)
+        self.shards = {}
+
+
+class MemmapStore(object):
+    """ Read-only access to a store written by MemmapStoreWriter.
+
+        Shards are memory-mapped lazily on first access, so the store can be
+        created in the main process and handed to DataLoader workers, each of
+        which maps the files itself. get() returns zero-copy views.
+    """
+    def __init__(self, root):
+        self.root = root
+        with open(osp.join(root, INDEX_FILE), 'r') as fp:
+            index = json.load(fp)
+        self.names = index['names']
+        self.fields = index['fields']
+        self.shard_size = index['shard_size']
+        self.num_shards = index['num_shards']
+        self.meta = index['meta']
+        self.name_to_index = dict((name, i) for i, name in enumerate(self.names))
+        self._shards = {}
+
+    @staticmethod
+    def exists(root):
+        return root is not None and osp.isfile(osp.join(root, INDEX_FILE))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.name_to_index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def _shard(self, field, shard):
+        key = (field, shard)
+        if key not in self._shards:
+            self._shards[key] = np.load(osp.join(self.root, '%s_%04d.npy' % (field, shard)), mmap_mode='r')
+        return self._shards[key]
+
+    def get(self, field, key):
+        """Return the array of `field` for a sample given by name or index."""
+        index = self.name_to_index[key] if isinstance(key, str) else key
+        shard, offset = divmod(index, self.shard_size)
+        return self._shard(field, shard)[offset]
@@ -0,0 +1,73 @@
+import torch
+from torch.utils import data
+
+
+class InfiniteSampler(data.Sampler):
+    """ Endless stream of dataset indices, reshuffled every epoch.
+
+        Replaces replicating img_ids up to max_iters: only the unique file
+        list is kept and the sampler simply never stops. The permutation of
+        epoch e is drawn from a generator seeded with seed + e, so the stream
+        is reproducible and can be resumed at any point by skipping
+        `start_index` samples without replaying the earlier epochs.
+
+        Example:
+        >>> sampler = InfiniteSampler(len(dst), seed=1234, start_index=i_iter * batch_size)
+        >>> loader = data.DataLoader(dst, batch_size=batch_size, sampler=sampler, drop_last=True)
+    """
+    def __init__(self, num_samples, shuffle=True, seed=0, start_index=0):
+        self.num_samples = num_samples
+        self.shuffle = shuffle
+        self.seed = seed
+        self.start_index = start_index
+
+    def __iter__(self):
+        epoch, offset = divmod(self.start_index, self.num_samples)
+        while True:
+            if self.shuffle:
+                g = torch.Generator()
+                g.manual_seed(self.seed + epoch)
+                order = torch.randperm(self.num_samples, generator=g)
+            else:
+                order = torch.arange(self.num_samples)
+            for index in order[offset:].tolist():
+                yield index
+            epoch += 1
+            offset = 0
+
+
+class PairedDataset(data.Dataset):
+    """ Source and target dataset behind a single DataLoader.
+
+        Indexed with (source_index, target_index) pairs, so each sample is
+        one source sample and one target sample and the default collate turns
+        a batch into (source_batch, target_batch). Both domains share one
+        worker pool and one prefetch queue: a worker always builds the two
+        halves of a batch together, so neither domain can run ahead of or
+        stall the other.
+
+        Example:
+        >>> sampler = PairedSampler(InfiniteSampler(len(src)), InfiniteSampler(len(tgt), seed=1))
+        >>> loader = data.DataLoader(PairedDataset(src, tgt), batch_size=batch_size, sampler=sampler, drop_last=True)
+        >>> batch, batch_t = next(iter(loader))
+    """
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+
+    def __len__(self):
+        return max(len(self.source), len(self.target))
+
+    def __getitem__(self, index):
+        i, j = index
+        return self.source[i], self.target[j]
+
+
+class PairedSampler(data.Sampler):
+    """Zip a source and a target sampler into (source_index, target_index) pairs."""
+    def __init__(self, source_sampler, target_sampler):
+        self.source_sampler = source_sampler
+        self.target_sampler = target_sampler
+
+    def __iter__(self):
+        return zip(self.source_sampler, self.target_sampler)
@@ -8,13 +8,18 @@ import torch
 import torchvision
 from torch.utils import data
 from PIL import Image, ImageFile
-from dataset.autoaugment import ImageNetPolicy
+from dataset.list_dataset import ListDataSet
+from dataset.crop_sampler import ClassRichCropSampler, resize_crop
+from utils.label_mapping import build_lut, map_labels
 import imageio
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# uint8 train-id labels written by convert_synthia_labels.py
+TRAINID_LABEL_DIR = 'GT/LABELS_trainid'
 
-class SynthiaDataSet(data.Dataset):
-    def __init__(self, root, list_path, max_iters=None, resize_size=(1024, 512), crop_size=(512, 1024), mean=(128, 128, 128), scale=False, mirror=True, ignore_label=255, autoaug = False):
+
+class SynthiaDataSet(ListDataSet):
+    def __init__(self, root, list_path, max_iters=None, resize_size=(1024, 512), crop_size=(512, 1024), mean=(128, 128, 128), scale=False, mirror=True, ignore_label=255, autoaug = False, return_uint8=False, crop_first=False):
         self.root = root
         self.list_path = list_path
         self.crop_size = crop_size
@@ -24,87 +29,96 @@ class SynthiaDataSet(data.Dataset):
         self.is_mirror = mirror
         self.resize_size = resize_size
         self.autoaug = autoaug
+        self.return_uint8 = return_uint8
+        self.crop_first = crop_first
         self.h = crop_size[0]
         self.w = crop_size[1]
         # self.mean_bgr = np.array([104.00698793, 116.66876762, 122.67891434])
         self.img_ids = [i_id.strip() for i_id in open(list_path)]
-        if not max_iters==None:
-            self.img_ids = self.img_ids * int(np.ceil(float(max_iters) / len(self.img_ids)))
+        self.set_num_samples(max_iters)
         self.files = []
 
         self.id_to_trainid = {3: 0, 4: 1, 2: 2, 21: 3, 5: 4, 7: 5,
                               15: 6, 9: 7, 6: 8, 16: 9, 1: 10, 10: 11, 17: 12,
                               8: 13, 18: 14, 19: 15, 20: 16, 12: 17, 11: 18}
+        self.lut = build_lut(self.id_to_trainid, num_entries=65536)
         # for split in ["train", "trainval", "val"]:
         for name in self.img_ids:
             img_file = osp.join(self.root, "RGB/%s" % name)
             label_file = osp.join(self.root, "GT/LABELS/%s" % name)
+            trainid_label_file = osp.join(self.root, TRAINID_LABEL_DIR, name)
             self.files.append({
                 "img": img_file,
                 "label": label_file,
+                "trainid_label": trainid_label_file,
                 "name": name
             })
 
-    def __len__(self):
-        return len(self.files)
+        # use the converted labels when every file of the list is there
+        self.use_trainid_labels = osp.isdir(osp.join(self.root, TRAINID_LABEL_DIR))
+        if self.use_trainid_labels:
+            missing = sum(not osp.isfile(f["trainid_label"]) for f in self.files)
+            if missing > 0:
+                print('%d labels missing in %s, reading the 16-bit labels instead.' % (missing, TRAINID_LABEL_DIR))
+                self.use_trainid_labels = False
 
 
     def __getitem__(self, index):
-        datafiles = self.files[index]
+        datafiles = self.files[index % len(self.files)]
 
         image = Image.open(datafiles["img"]).convert('RGB')
-        # label = Image.open(datafiles["label"])
-        # label = np.asarray(label)[:,:,0]
-        # label = Image.fromarray(label)
-        label = np.asarray(imageio.imread(datafiles["label"], format='PNG-FI'))[:,:,0]  # uint16
-        label = Image.fromarray(label)
+        if self.use_trainid_labels:
+            label = Image.open(datafiles["trainid_label"])
+        else:
+            # label = Image.open(datafiles["label"])
+            # label = np.asarray(label)[:,:,0]
+            # label = Image.fromarray(label)
+            label = np.asarray(imageio.imread(datafiles["label"], format='PNG-FI'))[:,:,0]  # uint16
+            label = Image.fromarray(label)
         name = datafiles["name"]
 
         # resize
         if self.scale:
             random_scale = 0.8 + random.random()*0.4 # 0.8 - 1.2
-            image = image.resize( ( round(self.resize_size[0] * random_scale), round(self.resize_size[1] * random_scale)) , Image.BICUBIC)
-            label = label.resize( ( round(self.resize_size[0] * random_scale), round(self.resize_size[1] * random_scale)) , Image.NEAREST)
-        else: 
-            image = image.resize( ( self.resize_size[0], self.resize_size[1] ) , Image.BICUBIC)
-            label = label.resize( ( self.resize_size[0], self.resize_size[1] ) , Image.NEAREST)
-
-        if self.autoaug:
-            policy = ImageNetPolicy()
-            image = policy(image)
-
-        image = np.asarray(image, np.float32)
-        label = np.asarray(label, np.uint8)
-
-        # re-assign labels to match the format of Cityscapes
-        label_copy = 255 * np.ones(label.shape, dtype=np.uint8)
-        for k, v in list(self.id_to_trainid.items()):
-            label_copy[label == k] = v
-
-        size = image.shape
-        image = image[:, :, ::-1]  # change to BGR
-        image -= self.mean
-        image = image.transpose((2, 0, 1))
-        print(image.shape, label.shape)
-        for i in range(10): #find hard samples
-            x1 = random.randint(0, image.shape[1] - self.h)
-            y1 = random.randint(0, image.shape[2] - self.w)
-            tmp_label_copy = label_copy[x1:x1+self.h, y1:y1+self.w]
-            tmp_image = image[:, x1:x1+self.h, y1:y1+self.w]
-            u =  np.unique(tmp_label_copy)
-            if len(u) > 10:
-                break
-            else:
-                continue
-                #print('GTA5: Too young too naive for %d times!'%i)
-
-        image = tmp_image
-        label_copy = tmp_label_copy
+            resize_size = ( round(self.resize_size[0] * random_scale), round(self.resize_size[1] * random_scale))
+        else:
+            resize_size = ( self.resize_size[0], self.resize_size[1] )
+        label = label.resize(resize_size, Image.NEAREST)
+        if not self.crop_first:
+            image = image.resize(resize_size, Image.BICUBIC)
+
+        if self.autoaug and not self.crop_first:
+            image = self.augment(image)
+
+        if self.use_trainid_labels:
+            label_copy = np.asarray(label, np.uint8)
+        else:
+            label = np.asarray(label)  # uint16
+
+            # re-assign labels to match the format of Cityscapes
+            label_copy = map_labels(label, self.lut)
+
+        size = (resize_size[1], resize_size[0], 3)
+        x1, y1 = ClassRichCropSampler(label_copy, self.h, self.w).sample() #find hard samples
+        if self.crop_first:
+            # the label is resized in full for the sampler, the image only under the crop
+            image = resize_crop(image, resize_size, x1, y1, self.h, self.w)
+            if self.autoaug:
+                image = self.augment(image)
+        else:
+            image = np.asarray(image, np.uint8)[x1:x1+self.h, y1:y1+self.w]
+        label_copy = label_copy[x1:x1+self.h, y1:y1+self.w]
 
         if self.is_mirror and random.random() < 0.5:
-            image = np.flip(image, axis = 2)
+            image = np.flip(image, axis = 1)
             label_copy = np.flip(label_copy, axis = 1)
 
+        if not self.return_uint8:
+            image = np.asarray(image, np.float32)
+            image = image[:, :, ::-1]  # change to BGR
+            image -= self.mean
+            image = image.transpose((2, 0, 1))
+
         return image.copy(), label_copy.copy(), np.array(size), name
 
 
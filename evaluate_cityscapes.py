@@ -4,9 +4,7 @@ from scipy import ndimage
 import numpy as np
 import sys
 from packaging import version
-from multiprocessing import Pool
 import torch
-from torch.autograd import Variable
 import torchvision.models as models
 import torch.nn.functional as F
 from torch.utils import data, model_zoo
@@ -14,15 +12,19 @@ from model.deeplab import Res_Deeplab
 from model.deeplab_multi import DeeplabMulti
 from model.deeplab_vgg import DeeplabVGG
 from model.deeplab_single import DeeplabSingle
-from dataset.cityscapes_dataset import cityscapesDataSet
+from model.tta import SlidingWindow, TTAAccumulator, TTAWrapper, single_pass
+from dataset.cityscapes_multiscale_dataset import cityscapesMultiScaleDataSet
+from dataset.gt_store import open_gt_store
 from collections import OrderedDict
 import os
 from PIL import Image
-from utils.tool import fliplr
-import matplotlib.pyplot as plt
+from utils.async_writer import AsyncWriter
+from utils.colormap import save_colormap
+from compute_iou import fast_hist_torch, load_info, per_class_iu, print_mIoU
 import torch.nn as nn
 import yaml
 import time
+import glob
 
 torch.backends.cudnn.benchmark = True
 
@@ -30,6 +32,8 @@ IMG_MEAN = np.array((104.00698793, 116.66876762, 122.67891434), dtype=np.float32
 
 DATA_DIRECTORY = './data/Cityscapes/data'
 DATA_LIST_PATH = './dataset/cityscapes_list/val.txt'
+DEVKIT_DIR = './dataset/cityscapes_list'
+GT_CACHE = './data/Cityscapes/gt_cache'
 SAVE_PATH = './result/cityscapes'
 
 IGNORE_LABEL = 255
@@ -41,6 +45,14 @@ RESTORE_FROM_ORC = 'http://vllab1.ucmerced.edu/~whung/adaptSeg/cityscapes_oracle
 SET = 'val'
 
 EPSILON = 1.0
+SCALES = '1.0,1.25'
+ARTIFACTS = 'label,color,heatmap,scoremap'
+WRITER_WORKERS = 4
+WRITER_QUEUE = 32
+INPUT_SIZE = '1024,512'
+TILE_OVERLAP = 0.25
+TILE_WEIGHT = 'gaussian'
+TILE_BATCH = 4
 
 MODEL = 'DeeplabMulti'
 ARCH='resnet101'
@@ -93,6 +105,8 @@ def get_arguments():
                         help="Number of classes to predict (including background).")
     parser.add_argument("--restore-from", type=str, default=RESTORE_FROM,
                         help="Where restore model parameters from.")
+    parser.add_argument("--sweep", type=str, default='',
+                        help="Comma-separated snapshots or glob patterns, evaluated together in one pass over the data.")
     parser.add_argument("--gpu", type=int, default=0,
                         help="choose gpu device.")
     parser.add_argument("--batchsize", type=int, default=16,
@@ -103,283 +117,300 @@ def get_arguments():
                         help="Path to save result.")
     parser.add_argument("--epsilon", type=float, default=EPSILON,
                         help="Hyper-parameter for noise")
+    parser.add_argument("--scales", type=str, default=SCALES,
+                        help="Comma-separated test-time scales, the first one also drives the heatmaps.")
+    parser.add_argument("--input-size", type=str, default=INPUT_SIZE,
+                        help="Comma-separated width and height the images are resized to at scale 1.0.")
+    parser.add_argument("--tile-size", type=str, default='',
+                        help="Comma-separated tile height and width, enables sliding-window inference.")
+    parser.add_argument("--tile-overlap", type=float, default=TILE_OVERLAP,
+                        help="Fraction of a tile shared with its neighbours.")
+    parser.add_argument("--tile-weight", type=str, default=TILE_WEIGHT,
+                        help="Blending of overlapping tiles: uniform or gaussian.")
+    parser.add_argument("--tile-batch", type=int, default=TILE_BATCH,
+                        help="Number of tiles per forward pass, bounds the peak memory.")
+    parser.add_argument("--devkit-dir", type=str, default=DEVKIT_DIR,
+                        help="Directory with the info.json describing the classes.")
+    parser.add_argument("--gt-cache", type=str, default=GT_CACHE,
+                        help="Directory of the cached train-id ground truth (one store per set), empty to decode the PNGs.")
+    parser.add_argument("--save-pred", action="store_true",
+                        help="Also write the prediction, heatmap and scoremap PNGs to --save.")
+    parser.add_argument("--artifacts", type=str, default=ARTIFACTS,
+                        help="Comma-separated outputs written with --save-pred: label, color, heatmap, scoremap.")
+    parser.add_argument("--writer-workers", type=int, default=WRITER_WORKERS,
+                        help="Number of processes writing the PNGs.")
+    parser.add_argument("--writer-queue", type=int, default=WRITER_QUEUE,
+                        help="Maximum number of images queued for writing before inference waits.")
     return parser.parse_args()
 
 
 def save(output_name):
     output, name = output_name
-    output_col = colorize_mask(output)
     output = Image.fromarray(output)
 
     output.save('%s' % (name))
+    return
+
+
+def save_color(output_name):
+    output, name = output_name
+    output_col = colorize_mask(output)
     output_col.save('%s_color.png' % (name.split('.jpg')[0]))
     return
 
 
 def save_heatmap(output_name):
     output, name = output_name
-    fig = plt.figure()
-    plt.axis('off')
-    heatmap = plt.imshow(output, cmap='viridis')
-    # fig.colorbar(heatmap)
-    fig.savefig('%s_heatmap.png' % (name.split('.jpg')[0]))
+    save_colormap(output, '%s_heatmap.png' % (name.split('.jpg')[0]))
     return
 
 
 def save_scoremap(output_name):
     output, name = output_name
-    fig = plt.figure()
-    plt.axis('off')
-    heatmap = plt.imshow(output, cmap='viridis')
-    # fig.colorbar(heatmap)
-    fig.savefig('%s_scoremap.png' % (name.split('.jpg')[0]))
+    save_colormap(output, '%s_scoremap.png' % (name.split('.jpg')[0]))
     return
 
 
-def main():
-    """Create the model and start the evaluation process."""
-    args = get_arguments()
-
-    config_path = os.path.join(os.path.dirname(args.restore_from), 'opts.yaml')
-    with open(config_path, 'r') as stream:
-        config = yaml.load(stream)
-
-    args.model = config['model']
-    print('ModelType:%s' % args.model)
-    print('NormType:%s' % config['norm_style'])
-    gpu0 = args.gpu
-    batchsize = args.batchsize
-
-    if not os.path.exists(args.save):
-        os.makedirs(args.save)
-
-    if args.model == 'DeepLab':
+def load_model(args, config, restore_from, device):
+    """Build the network described by config and load the weights of restore_from."""
+    if config['model'] == 'DeepLab':
         model = DeeplabMulti(num_classes=args.num_classes, use_se=config['use_se'], train_bn=False,
                              norm_style=config['norm_style'])
-    elif args.model == 'DeepLabMulti':
+    elif config['model'] == 'DeepLabMulti':
         model = DeeplabMulti(num_classes=args.num_classes, use_se=config['use_se'], train_bn=False,
                              norm_style=config['norm_style'], arch=args.arch)
-    elif args.model == 'Oracle':
+    elif config['model'] == 'Oracle':
         model = Res_Deeplab(num_classes=args.num_classes)
-        if args.restore_from == RESTORE_FROM:
-            args.restore_from = RESTORE_FROM_ORC
-    elif args.model == 'DeeplabVGG':
+        if restore_from == RESTORE_FROM:
+            restore_from = RESTORE_FROM_ORC
+    elif config['model'] == 'DeeplabVGG':
         model = DeeplabVGG(num_classes=args.num_classes)
-        if args.restore_from == RESTORE_FROM:
-            args.restore_from = RESTORE_FROM_VGG
-    elif args.model == 'DeepLabSingle':
+        if restore_from == RESTORE_FROM:
+            restore_from = RESTORE_FROM_VGG
+    elif config['model'] == 'DeepLabSingle':
         model = DeeplabSingle(num_classes=args.num_classes, use_se=config['use_se'],
                               train_bn=False, norm_style=config['norm_style'])
     else:
         raise Exception('Please choose right model.')
 
-    if args.restore_from[:4] == 'http':
-        saved_state_dict = model_zoo.load_url(args.restore_from)
+    if restore_from[:4] == 'http':
+        saved_state_dict = model_zoo.load_url(restore_from, map_location='cpu')
     else:
-        saved_state_dict = torch.load(args.restore_from)
+        saved_state_dict = torch.load(restore_from, map_location='cpu')
 
     try:
         model.load_state_dict(saved_state_dict)
     except:
         model = torch.nn.DataParallel(model)
         model.load_state_dict(saved_state_dict)
-        if args.model == 'DeepLabSingle':
+        if config['model'] == 'DeepLabSingle':
             model = model.module
     model.eval()
-    model.cuda(gpu0)
-
-
-    testloader = data.DataLoader(
-        cityscapesDataSet(args.data_dir, args.data_list, crop_size=(512, 1024), resize_size=(1024, 512), mean=IMG_MEAN,
-                          scale=False, mirror=False, set=args.set),
-        batch_size=batchsize, shuffle=False, pin_memory=True, num_workers=4)
-
-    scale = 1.25
-    testloader2 = data.DataLoader(
-        cityscapesDataSet(args.data_dir, args.data_list, crop_size=(round(512 * scale), round(1024 * scale)),
-                          resize_size=(round(1024 * scale), round(512 * scale)), mean=IMG_MEAN, scale=False,
-                          mirror=False, set=args.set),
-        batch_size=batchsize, shuffle=False, pin_memory=True, num_workers=4)
-    scale = 0.9
-    testloader3 = data.DataLoader(
-        cityscapesDataSet(args.data_dir, args.data_list, crop_size=(round(512 * scale), round(1024 * scale)),
-                          resize_size=(round(1024 * scale), round(512 * scale)), mean=IMG_MEAN, scale=False,
-                          mirror=False, set=args.set),
-        batch_size=batchsize, shuffle=False, pin_memory=True, num_workers=4)
+    model.to(device)
+    return model
+
 
+def load_config(restore_from):
+    config_path = os.path.join(os.path.dirname(restore_from), 'opts.yaml')
+    with open(config_path, 'r') as stream:
+        config = yaml.load(stream)
+    return config
+
+
+def expand_checkpoints(sweep):
+    """Comma-separated snapshot files or glob patterns, in the given order."""
+    checkpoints = []
+    for pattern in sweep.split(','):
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise ValueError('No snapshot matches %s.' % pattern)
+        checkpoints += [path for path in matches if path not in checkpoints]
+    return checkpoints
+
+
+def predict(args, net, images, device, with_heatmap=False):
+    """ Test-time augmented prediction of one batch with the model in `net`.
+
+        Returns the TTAAccumulator and, when with_heatmap is set, the heatmaps
+        of the model type as a numpy array (None otherwise).
+    """
     if version.parse(torch.__version__) >= version.parse('0.4.0'):
         interp = nn.Upsample(size=(1024, 2048), mode='bilinear', align_corners=True)
     else:
         interp = nn.Upsample(size=(1024, 2048), mode='bilinear')
-
     sm = torch.nn.Softmax(dim=1)
     log_sm = torch.nn.LogSoftmax(dim=1)
     kl_distance = nn.KLDivLoss(reduction='none')
 
-    for index, img_data in enumerate(zip(testloader, testloader2, testloader3)):
-        batch, batch2, batch3 = img_data
-        image, _, _, name = batch
-        image2, _, _, name2 = batch2
-        # image3, _, _, name3 = batch3
+    heatmap_batch = None
+    if net['sliding_window'] is not None:
+        tta = TTAAccumulator(out_size=(1024, 2048))
+        for image2 in images:
+            tta.add(net['sliding_window'](image2.to(device)))
+        if with_heatmap:
+            heatmap_batch = np.full((tta.sum.shape[0], 1024, 2048), tta.sum.shape[1], dtype=np.float32)
+    elif net['type'] == 'DeepLab':
+        # original and flipped inputs of every scale in one forward each
+        tta, outputs = net['tta_model']([image2.to(device) for image2 in images])
+        if with_heatmap:
+            heatmap_output1 = outputs[0][0] + outputs[1][0]
+            heatmap_output2 = outputs[0][1] + outputs[1][1]
+            heatmap_batch = torch.sum(kl_distance(log_sm(heatmap_output1), sm(heatmap_output2)), dim=1)
+            heatmap_batch = torch.log(1 + 10 * heatmap_batch)  # for visualization
+            heatmap_batch = heatmap_batch.cpu().data.numpy()
+        del outputs
+    elif net['type'] == 'DeepLabMulti':
+        tta, outputs = net['tta_model']([image2.to(device) for image2 in images])
+        if with_heatmap:
+            output1, output2 = outputs[0]
+            # noise1 = sample_unit_vec(output1.shape[1:], output1.shape[0])
+            noise = sample_unit_vec(output2.shape[1:], output2.shape[0])
+            if torch.cuda.is_available():
+                noise = noise.cuda()
+            output2_n = output2 + args.epsilon * noise
+            output_noise = interp(sm(output2_n))
+            output2 = interp(sm(output2))
+            heatmap_batch = torch.sum(kl_distance(log_sm(output_noise), sm(output2)), dim=1)
+            heatmap_batch = (heatmap_batch - torch.min(heatmap_batch)) / (torch.max(heatmap_batch) - torch.min(heatmap_batch))
+            output_diff = torch.abs(torch.argmax(output_noise, dim=1) - torch.argmax(output2, dim=1))
+            heatmap_batch = output_diff * heatmap_batch
+
+            weights = torch.ones(1, 1, 15, 15).type_as(heatmap_batch)
+            padding = 7
+            heatmap_batch = torch.nn.functional.conv2d(heatmap_batch.unsqueeze(1), weights, padding=padding)
+            heatmap_batch = torch.nn.functional.conv2d(heatmap_batch, weights, padding=padding).squeeze()
+            del output1, output2, output2_n, output_noise
+
+            # heatmap_batch = torch.log(1 + 100 * heatmap_batch)
+            heatmap_batch = heatmap_batch.cpu().data.numpy()
+        del outputs
+    elif net['type'] == 'DeepLabSingle':
+        tta, _ = net['tta_model']([image2.to(device) for image2 in images])
+        if with_heatmap:
+            heatmap_batch = np.full((tta.sum.shape[0], 1024, 2048), tta.sum.shape[1], dtype=np.float32)
+    elif net['type'] == 'DeeplabVGG' or net['type'] == 'Oracle':
+        tta = single_pass(net['model'], images[0].to(device))
+    return tta, heatmap_batch
+
+
+def main():
+    """Create the model and start the evaluation process."""
+    args = get_arguments()
+
+    gpu0 = args.gpu
+    device = torch.device('cuda:%d' % gpu0 if torch.cuda.is_available() else 'cpu')
+    batchsize = args.batchsize
+    scales = [float(scale) for scale in args.scales.split(',')]
+
+    # a sweep keeps every snapshot on the device and feeds each batch to all of them
+    checkpoints = expand_checkpoints(args.sweep) if args.sweep else [args.restore_from]
+    if args.save_pred and len(checkpoints) > 1:
+        raise ValueError('--save-pred writes the predictions of a single snapshot, not of a sweep.')
+    nets = []
+    for restore_from in checkpoints:
+        config = load_config(restore_from)
+        print('%s ModelType:%s NormType:%s' % (restore_from, config['model'], config['norm_style']))
+        model = load_model(args, config, restore_from, device)
+        if args.tile_size:
+            # tiles bound the memory, so the input can be native resolution or larger
+            sliding_window = SlidingWindow(model, tile_size=[int(i) for i in args.tile_size.split(',')],
+                                           overlap=args.tile_overlap, weight=args.tile_weight,
+                                           tile_batch=args.tile_batch, flips=(False, True))
+        else:
+            sliding_window = None
+        nets.append({
+            'restore_from': restore_from,
+            'type': config['model'],
+            'model': model,
+            'tta_model': TTAWrapper(model, scales=scales, flips=(False, True), out_size=(1024, 2048)),
+            'sliding_window': sliding_window,
+        })
+
+    artifacts = args.artifacts.split(',')
+    if args.save_pred:
+        if not os.path.exists(args.save):
+            os.makedirs(args.save)
+        writer = AsyncWriter(num_workers=args.writer_workers, max_pending=args.writer_queue)
+    with_heatmap = args.save_pred and 'heatmap' in artifacts
+
+    # one decode per image, resized to every scale
+    input_w, input_h = map(int, args.input_size.split(','))
+    testset = cityscapesMultiScaleDataSet(args.data_dir, args.data_list, scales=scales, resize_size=(input_w, input_h),
+                                          mean=IMG_MEAN, set=args.set, with_label=True)
+    if args.gt_cache:
+        testset.label_store = open_gt_store(os.path.join(args.gt_cache, args.set),
+                                            os.path.join(args.data_dir, 'gtFine', args.set),
+                                            [f['label_name'] for f in testset.files], testset.lut)
+    testloader = data.DataLoader(testset, batch_size=batchsize, shuffle=False, pin_memory=True, num_workers=4)
+
+    # confusion matrices accumulated on the device, one per snapshot
+    num_classes, name_classes, _ = load_info(args.devkit_dir)
+    hist = torch.zeros(len(nets), num_classes, num_classes, dtype=torch.long).to(device)
+
+    for index, batch in enumerate(testloader):
+        images, labels, _, name = batch
+        name = list(name)
+        labels = labels.to(device)
 
-        inputs = image.cuda(gpu0)
-        inputs2 = image2.cuda(gpu0)
-        # inputs3 = Variable(image3).cuda()
         print('\r>>>>Extracting feature...%03d/%03d' % (index * batchsize, NUM_STEPS), end='')
-        if args.model == 'DeepLab':
+        for k, net in enumerate(nets):
             with torch.no_grad():
-                output1, output2 = model(inputs)
-                output_batch = interp(sm(0.5 * output1 + output2))
-                heatmap_output1, heatmap_output2 = output1, output2
-                # output_batch = interp(sm(output1))
-                # output_batch = interp(sm(output2))
-                output1, output2 = model(fliplr(inputs))
-                output1, output2 = fliplr(output1), fliplr(output2)
-                output_batch += interp(sm(0.5 * output1 + output2))
-                heatmap_output1, heatmap_output2 = heatmap_output1 + output1, heatmap_output2 + output2
-                # output_batch += interp(sm(output1))
-                # output_batch += interp(sm(output2))
-                del output1, output2, inputs
-
-                output1, output2 = model(inputs2)
-                output_batch += interp(sm(0.5 * output1 + output2))
-                # output_batch += interp(sm(output1))
-                # output_batch += interp(sm(output2))
-                output1, output2 = model(fliplr(inputs2))
-                output1, output2 = fliplr(output1), fliplr(output2)
-                output_batch += interp(sm(0.5 * output1 + output2))
-                # output_batch += interp(sm(output1))
-                # output_batch += interp(sm(output2))
-                del output1, output2, inputs2
-                output_batch = output_batch.cpu().data.numpy()
-                heatmap_batch = torch.sum(kl_distance(log_sm(heatmap_output1), sm(heatmap_output2)), dim=1)
-                heatmap_batch = torch.log(1 + 10 * heatmap_batch)  # for visualization
-                heatmap_batch = heatmap_batch.cpu().data.numpy()
-
-                # output1, output2 = model(inputs3)
-                # output_batch += interp(sm(0.5* output1 + output2)).cpu().data.numpy()
-                # output1, output2 = model(fliplr(inputs3))
-                # output1, output2 = fliplr(output1), fliplr(output2)
-                # output_batch += interp(sm(0.5 * output1 + output2)).cpu().data.numpy()
-                # del output1, output2, inputs3
-        elif args.model == 'DeepLabMulti':
-            with torch.no_grad():
-                output1, output2 = model(inputs)
-                # noise1 = sample_unit_vec(output1.shape[1:], output1.shape[0])
-                noise = sample_unit_vec(output2.shape[1:], output2.shape[0])
-                if torch.cuda.is_available():
-                    noise = noise.cuda()
-                output2_n = output2 + args.epsilon * noise
-                # output2 = interp(sm(output2))
-                output_batch = interp(sm(0.5 * output1 + output2))
-                output_noise = interp(sm(output2_n))
-                output2 = interp(sm(output2))
-                heatmap_batch = torch.sum(kl_distance(log_sm(output_noise), sm(output2)), dim=1)
-                heatmap_batch = (heatmap_batch - torch.min(heatmap_batch)) / (torch.max(heatmap_batch) - torch.min(heatmap_batch))
-                output_diff = torch.abs(torch.argmax(output_noise, dim=1) - torch.argmax(output2, dim=1))
-                heatmap_batch = output_diff * heatmap_batch
-
-                weights = torch.ones(1, 1, 15, 15).type_as(heatmap_batch)
-                padding = 7
-                heatmap_batch = torch.nn.functional.conv2d(heatmap_batch.unsqueeze(1), weights, padding=padding)
-                heatmap_batch = torch.nn.functional.conv2d(heatmap_batch, weights, padding=padding).squeeze()
-
-                # heatmap_batch = 1e8 * heatmap_batch.data.cpu().numpy()
-                # heatmap_batch = heatmap_batch.data.cpu().numpy()
-                # thres = np.percentile(heatmap_batch[:], 95, axis=0)
-                # heatmap_batch[heatmap_batch < thres] = 0
-                # heatmap_batch = torch.nn.functional.sigmoid(heatmap_batch)
-                # heatmap_batch = torch.nn.functional.sigmoid(heatmap_batch)
-                # print(heatmap_batch[0])
-                # heatmap_batch = torch.log(1 + heatmap_batch)
-                # del output1, output2, output_noise
-                del output1, output2
-
-                output1, output2 = model(fliplr(inputs))
-                output1, output2 = fliplr(output1), fliplr(output2)
-                output_batch += interp(sm(0.5 * output1 + output2))
-
-                del output1, output2, inputs
-
-                output1, output2 = model(inputs2)
-                output_batch += interp(sm(0.5 * output1 + output2))
-                output1, output2 = model(fliplr(inputs2))
-                output1, output2 = fliplr(output1), fliplr(output2)
-                output_batch += interp(sm(0.5 * output1 + output2))
-
-                del output1, output2, inputs2
-
-                # heatmap_batch = torch.sum(torch.ones_like(output_batch), dim=1).cpu().data.numpy()
-                output_batch = output_batch.cpu().data.numpy()
-                # heatmap_batch = torch.log(1 + 100 * heatmap_batch)
-                heatmap_batch = heatmap_batch.cpu().data.numpy()
-
-        elif args.model == 'DeepLabSingle':
-            with torch.no_grad():
-                output = model.extractor(inputs)
-                # noise = sample_unit_vec(output.shape[1:], output.shape[0])
-                # if torch.cuda.is_available():
-                #     noise = noise.cuda()
-                # output_n = output + args.epsilon * noise
-                output = model.classifier(output)
-                # output_n = model.classifier(output_n)
-                # output_noise = interp(sm(output_n))
-                output_batch = interp(sm(output))
-
-                # heatmap_batch = torch.sum(kl_distance(log_sm(output_noise), sm(output)), dim=1)
-                # heatmap_batch = (heatmap_batch - torch.min(heatmap_batch)) / (torch.max(heatmap_batch) - torch.min(heatmap_batch))
-                # del output, output_n
-                del output
-
-                output = model(fliplr(inputs))
-                output = fliplr(output)
-                output_batch += interp(sm(output))
-
-                del output, inputs
-
-                output = model(inputs2)
-                output_batch += interp(sm(output))
-                del output
-                output = model(fliplr(inputs2))
-                output = fliplr(output)
-                output_batch += interp(sm(output))
-
-                # del output, inputs2
-
-                heatmap_batch = torch.sum(torch.ones_like(output_batch), dim=1).cpu().data.numpy()
-                output_batch = output_batch.cpu().data.numpy()
-                # heatmap_batch = torch.log(1 + 100 * heatmap_batch)
-                # heatmap_batch = heatmap_batch.cpu().data.numpy()
-        elif args.model == 'DeeplabVGG' or args.model == 'Oracle':
-            output_batch = model(Variable(image).cuda())
-            output_batch = interp(output_batch).cpu().data.numpy()
-
-        output_batch = output_batch.transpose(0, 2, 3, 1)
-        scoremap_batch = np.asarray(np.max(output_batch, axis=3))
-        output_batch = np.asarray(np.argmax(output_batch, axis=3), dtype=np.uint8)
-        output_iterator = []
-        heatmap_iterator = []
-        scoremap_iterator = []
-
+                tta, heatmap_batch = predict(args, net, images, device, with_heatmap)
+
+            # the TTA sum stays on the output grid, prediction and score are upsampled in bands
+            pred_batch, scoremap_batch = tta.argmax_max()
+            del tta
+            if labels.shape != pred_batch.shape:
+                if k == 0:
+                    print('\nSkipping %s: label size %s does not match prediction size %s'
+                          % (name[0], tuple(labels.shape[1:]), tuple(pred_batch.shape[1:])))
+            else:
+                hist[k] += fast_hist_torch(labels, pred_batch, num_classes)
+        del labels
+
+        if not args.save_pred:
+            del pred_batch, scoremap_batch
+            continue
+
+        output_batch = np.asarray(pred_batch.cpu().numpy(), dtype=np.uint8)
+        scoremap_batch = scoremap_batch.cpu().numpy()
+        del pred_batch
+
+        # queued on the long-lived writer pool, inference goes on with the next batch
         for i in range(output_batch.shape[0]):
-            output_iterator.append(output_batch[i, :, :])
-            heatmap_iterator.append(heatmap_batch[i, :, :] / np.max(heatmap_batch[i, :, :]))
-            scoremap_iterator.append(1 - scoremap_batch[i, :, :] / np.max(scoremap_batch[i, :, :]))
             name_tmp = name[i].split('/')[-1]
             name[i] = '%s/%s' % (args.save, name_tmp)
-        with Pool(4) as p:
-            p.map(save, zip(output_iterator, name))
-            p.map(save_heatmap, zip(heatmap_iterator, name))
-            p.map(save_scoremap, zip(scoremap_iterator, name))
+            if 'label' in artifacts:
+                writer.submit(save, (output_batch[i, :, :], name[i]))
+            if 'color' in artifacts:
+                writer.submit(save_color, (output_batch[i, :, :], name[i]))
+            if 'heatmap' in artifacts:
+                writer.submit(save_heatmap, (heatmap_batch[i, :, :] / np.max(heatmap_batch[i, :, :]), name[i]))
+            if 'scoremap' in artifacts:
+                writer.submit(save_scoremap, (1 - scoremap_batch[i, :, :] / np.max(scoremap_batch[i, :, :]), name[i]))
+        print(' writer queue %d' % writer.depth(), end='')
 
         del output_batch
 
-    return args.save
+    if args.save_pred:
+        writer.close()
+    print('')
+    hist = hist.cpu().numpy()
+    if len(nets) == 1:
+        return print_mIoU(hist[0], name_classes)
+
+    mIoUs = [np.nanmean(per_class_iu(h)) for h in hist]
+    ranking = sorted(range(len(nets)), key=lambda k: -np.nan_to_num(mIoUs[k], nan=-1))
+    print('>>>> Best snapshot %s' % nets[ranking[0]]['restore_from'])
+    print_mIoU(hist[ranking[0]], name_classes)
+    print('rank\tmIoU\tsnapshot')
+    for rank, k in enumerate(ranking):
+        print('%d\t%.2f\t%s' % (rank + 1, mIoUs[k] * 100, nets[k]['restore_from']))
+    return mIoUs
 
 
 if __name__ == '__main__':
     tt = time.time()
     with torch.no_grad():
-        save_path = main()
+        main()
     print('Time used: {} sec'.format(time.time() - tt))
-    os.system('python compute_iou.py ./data/Cityscapes/data/gtFine/val %s' % save_path)
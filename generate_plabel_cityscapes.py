@@ -4,25 +4,23 @@ from scipy import ndimage
 import numpy as np
 import sys
 import re
-from packaging import version
 
 import torch
-from torch.autograd import Variable
 import torchvision.models as models
 import torch.nn.functional as F
-from torch.utils import data, model_zoo
-from model.deeplab import Res_Deeplab
-from model.deeplab_multi import DeeplabMulti
-from model.deeplab_vgg import DeeplabVGG
-from model.deeplab_single import DeeplabSingle
-from dataset.cityscapes_dataset import cityscapesDataSet
+from torch.utils import data
+from model.tta import TTAWrapper, quantize_conf, single_pass
+from dataset.cityscapes_multiscale_dataset import cityscapesMultiScaleDataSet
 from collections import OrderedDict
 import os
 from PIL import Image
-from utils.tool import fliplr
-import matplotlib.pyplot as plt
+from utils.colormap import save_colormap
+from utils.async_writer import AsyncWriter
+from evaluate_cityscapes import load_config, load_model
+from dataset.memmap_store import MemmapStore, MemmapStoreWriter
 import torch.nn as nn
-import yaml
+import time
+import collections
 
 torch.backends.cudnn.benchmark = True
 
@@ -32,10 +30,6 @@ DATA_DIRECTORY = './data/Cityscapes/data'
 DATA_LIST_PATH = './dataset/cityscapes_list/train.txt'
 SAVE_PATH = './data/Cityscapes/data/pseudo/train'
 
-if not os.path.isdir('./data/Cityscapes/data/pseudo/'):
-    os.mkdir('./data/Cityscapes/data/pseudo/')
-    os.mkdir(SAVE_PATH)
-
 IGNORE_LABEL = 255
 NUM_CLASSES = 19
 NUM_STEPS = 2975  # Number of images in the validation set.
@@ -47,6 +41,13 @@ SET = 'train'  # We generate pseudo label for training set
 EPSILON=0.2
 
 MODEL = 'DeeplabMulti'
+ARCH = 'resnet101'
+SCALES = '1.0,1.25'
+ARTIFACTS = 'label'
+SHARD = '0/1'
+NUM_WORKERS = 4
+WRITER_WORKERS = 4
+WRITER_QUEUE = 32
 
 palette = [128, 64, 128, 244, 35, 232, 70, 70, 70, 102, 102, 156, 190, 153, 153, 153, 153, 153, 250, 170, 30,
            220, 220, 0, 107, 142, 35, 152, 251, 152, 70, 130, 180, 220, 20, 60, 255, 0, 0, 0, 0, 142, 0, 0, 70,
@@ -104,208 +105,223 @@ def get_arguments():
                         help="Path to save result.")
     parser.add_argument("--epsilon", type=float, default=EPSILON,
                         help="Hyper-parameter for noise")
+    parser.add_argument("--arch", type=str, default=ARCH,
+                        help="available options: resnet101, resnet50")
+    parser.add_argument("--scales", type=str, default=SCALES,
+                        help="Comma-separated test-time scales.")
+    parser.add_argument("--artifacts", type=str, default=ARTIFACTS,
+                        help="Comma-separated outputs: label, color, heatmap.")
+    parser.add_argument("--num-workers", type=int, default=NUM_WORKERS,
+                        help="Number of processes decoding the images.")
+    parser.add_argument("--writer-workers", type=int, default=WRITER_WORKERS,
+                        help="Number of processes writing the PNGs.")
+    parser.add_argument("--store", type=str, default='',
+                        help="Directory of a memory-mapped store receiving the labels and their uint8 confidence, "
+                             "thresholded later by cityscapes_pseudo_DataSet.")
+    parser.add_argument("--shard", type=str, default=SHARD,
+                        help="i/N: only generate every N-th image starting at i, e.g. one shard per process or machine.")
+    parser.add_argument("--merge", action="store_true",
+                        help="Check that the manifests of all N shards cover the list and merge the shard stores.")
+    parser.add_argument("--writer-queue", type=int, default=WRITER_QUEUE,
+                        help="Maximum number of images queued for writing before inference waits.")
     return parser.parse_args()
 
 
+def save(output_name):
+    output, name = output_name
+    Image.fromarray(output).save(name)
+    return
+
+
+def save_color(output_name):
+    output, name = output_name
+    colorize_mask(output).save(name)
+    return
+
+
 def save_heatmap(output_name):
     output, name = output_name
-    fig = plt.figure()
-    plt.axis('off')
-    heatmap = plt.imshow(output, cmap='viridis')
-    fig.colorbar(heatmap)
-    fig.savefig('%s_heatmap.png' % (name.split('.jpg')[0]))
+    save_colormap(output / np.max(output), name)
     return
 
 
+def manifest_path(save, shard, num_shards):
+    return os.path.join(save, 'manifest_%dof%d.txt' % (shard, num_shards))
+
+
+def read_manifest(path):
+    """Names finished by a shard, the manifest is appended after their outputs are written."""
+    if not os.path.isfile(path):
+        return set()
+    with open(path, 'r') as fp:
+        return set(line.strip() for line in fp if line.strip())
+
+
+def store_path(store, shard, num_shards):
+    if num_shards == 1:
+        return store
+    return os.path.join(store, 'part_%dof%d' % (shard, num_shards))
+
+
+def merge(args):
+    """Check that all shards together covered the list, merge their stores."""
+    _, num_shards = map(int, args.shard.split('/'))
+    names = [i_id.strip() for i_id in open(args.data_list)]
+    done = set()
+    for shard in range(num_shards):
+        shard_done = read_manifest(manifest_path(args.save, shard, num_shards))
+        print('Shard %d/%d: %d images done' % (shard, num_shards, len(shard_done)))
+        done |= shard_done
+    missing = [name for name in names if name not in done]
+    if missing:
+        print('%d of %d images are missing, e.g.:' % (len(missing), len(names)))
+        for name in missing[:10]:
+            print('  %s' % name)
+        sys.exit('Pseudo labels are incomplete, rerun the unfinished shards.')
+    print('All %d images are covered.' % len(names))
+
+    if args.store and num_shards > 1:
+        parts = [MemmapStore(store_path(args.store, shard, num_shards)) for shard in range(num_shards)]
+        fields = dict((k, (v['shape'], v['dtype'])) for k, v in parts[0].fields.items())
+        writer = MemmapStoreWriter(args.store, names, fields, meta=parts[0].meta)
+        for index, name in enumerate(names):
+            part = next(part for part in parts if name in part)
+            writer.write(index, **dict((field, part.get(field, name)) for field in fields))
+        writer.close()
+        print('Shard stores merged into %s, the part_* directories can be removed.' % os.path.abspath(args.store))
+
+
 def main():
     """Create the model and start the evaluation process."""
 
     args = get_arguments()
+    if args.merge:
+        return merge(args)
 
-    config_path = os.path.join(os.path.dirname(args.restore_from), 'opts.yaml')
-    with open(config_path, 'r') as stream:
-        config = yaml.load(stream)
-
+    config = load_config(args.restore_from)
     args.model = config['model']
     print('ModelType:%s' % args.model)
     print('NormType:%s' % config['norm_style'])
     gpu0 = args.gpu
+    device = torch.device('cuda:%d' % gpu0 if torch.cuda.is_available() else 'cpu')
     batchsize = args.batchsize
 
     model_name = os.path.basename(os.path.dirname(args.restore_from))
     # args.save += model_name
 
-    if not os.path.exists(args.save):
-        os.makedirs(args.save)
+    model = load_model(args, config, args.restore_from, device)
 
-    if args.model == 'DeepLab':
-        model = DeeplabMulti(num_classes=args.num_classes, use_se=config['use_se'], train_bn=False,
-                             norm_style=config['norm_style'])
-    elif args.model == 'DeepLabMulti':
-        model = DeeplabMulti(num_classes=args.num_classes, use_se=config['use_se'], train_bn=False,
-                             norm_style=config['norm_style'])
-    elif args.model == 'Oracle':
-        model = Res_Deeplab(num_classes=args.num_classes)
-        if args.restore_from == RESTORE_FROM:
-            args.restore_from = RESTORE_FROM_ORC
-    elif args.model == 'DeeplabVGG':
-        model = DeeplabVGG(num_classes=args.num_classes)
-        if args.restore_from == RESTORE_FROM:
-            args.restore_from = RESTORE_FROM_VGG
-    elif args.model == 'DeepLabSingle':
-        model = DeeplabSingle(num_classes=args.num_classes, use_se=config['use_se'], train_bn=False,
-                              norm_style=config['norm_style'])
-    else:
-        raise Exception('Please choose right model.')
-
-    if args.restore_from[:4] == 'http':
-        saved_state_dict = model_zoo.load_url(args.restore_from)
-    else:
-        saved_state_dict = torch.load(args.restore_from)
-
-    try:
-        model.load_state_dict(saved_state_dict)
-    except:
-        model = torch.nn.DataParallel(model)
-        model.load_state_dict(saved_state_dict)
-        if args.model == 'DeepLabSingle':
-            model = model.module
-    model.eval()
-    model.cuda(gpu0)
-
-    testloader = data.DataLoader(
-        cityscapesDataSet(args.data_dir, args.data_list, crop_size=(512, 1024), resize_size=(1024, 512), mean=IMG_MEAN,
-                          scale=False, mirror=False, set=args.set),
-        batch_size=batchsize, shuffle=False, pin_memory=True, num_workers=0)
-
-    scale = 1.25
-    testloader2 = data.DataLoader(
-        cityscapesDataSet(args.data_dir, args.data_list, crop_size=(round(512 * scale), round(1024 * scale)),
-                          resize_size=(round(1024 * scale), round(512 * scale)), mean=IMG_MEAN, scale=False,
-                          mirror=False, set=args.set),
-        batch_size=batchsize, shuffle=False, pin_memory=True, num_workers=0)
-
-    if version.parse(torch.__version__) >= version.parse('0.4.0'):
-        interp = nn.Upsample(size=(1024, 2048), mode='bilinear', align_corners=True)
-    else:
-        interp = nn.Upsample(size=(1024, 2048), mode='bilinear')
+    # one decode per image, resized to every scale, in parallel workers
+    scales = [float(scale) for scale in args.scales.split(',')]
+    testset = cityscapesMultiScaleDataSet(args.data_dir, args.data_list, scales=scales, resize_size=(1024, 512),
+                                          mean=IMG_MEAN, set=args.set)
 
+    # this shard's images, minus the ones its manifest already lists
+    shard, num_shards = map(int, args.shard.split('/'))
+    shard_files = testset.files[shard::num_shards]
+    store_index = dict((f['name'], index) for index, f in enumerate(shard_files))
+    if not os.path.exists(args.save):
+        os.makedirs(args.save)
+    manifest = manifest_path(args.save, shard, num_shards)
+    done = read_manifest(manifest)
+    testset.files = [f for f in shard_files if f['name'] not in done]
+    print('Shard %d/%d: %d images, %d already done' % (shard, num_shards, len(shard_files), len(shard_files) - len(testset.files)))
+    testloader = data.DataLoader(testset, batch_size=batchsize, shuffle=False, pin_memory=True,
+                                 num_workers=args.num_workers)
+
+    # output directories are created once instead of checked per image
+    for dir_name in sorted(set(f['name'].split('/')[-2] for f in testset.files)):
+        save_path = os.path.join(args.save, dir_name)
+        if not os.path.isdir(save_path):
+            os.makedirs(save_path)
+
+    tta_model = TTAWrapper(model, scales=scales, flips=(False, True), out_size=(1024, 2048))
     sm = torch.nn.Softmax(dim=1)
     log_sm = torch.nn.LogSoftmax(dim=1)
     kl_distance = nn.KLDivLoss(reduction='none')
 
-    for index, img_data in enumerate(zip(testloader, testloader2)):
-        batch, batch2 = img_data
-        image, _, _, name = batch
-        image2, _, _, name2 = batch2
-        print(image.shape)
-
-        inputs = image.cuda()
-        inputs2 = image2.cuda()
-        print('\r>>>>Extracting feature...%04d/%04d' % (index * batchsize, NUM_STEPS), end='')
-        if args.model == 'DeepLab':
-            with torch.no_grad():
-                output1, output2 = model(inputs)
-                output_batch = interp(sm(0.5 * output1 + output2))
-
-                heatmap_batch = torch.sum(kl_distance(log_sm(output1), sm(output2)), dim=1)
-
-                output1, output2 = model(fliplr(inputs))
-                output1, output2 = fliplr(output1), fliplr(output2)
-                output_batch += interp(sm(0.5 * output1 + output2))
-                del output1, output2, inputs
-
-                output1, output2 = model(inputs2)
-                output_batch += interp(sm(0.5 * output1 + output2))
-                output1, output2 = model(fliplr(inputs2))
-                output1, output2 = fliplr(output1), fliplr(output2)
-                output_batch += interp(sm(0.5 * output1 + output2))
-                del output1, output2, inputs2
-                output_batch = output_batch.cpu().data.numpy()
-                heatmap_batch = heatmap_batch.cpu().data.numpy()
-        elif args.model == 'DeepLabMulti':
-            with torch.no_grad():
-                output1, output2 = model(inputs)
-                output_batch = interp(sm(0.5 * output1 + output2))
-                output1, output2 = model(fliplr(inputs))
-                output1, output2 = fliplr(output1), fliplr(output2)
-                output_batch += interp(sm(0.5 * output1 + output2))
-
-                del output1, output2, inputs
-
-                output1, output2 = model(inputs2)
-                output_batch += interp(sm(0.5 * output1 + output2))
-                output1, output2 = model(fliplr(inputs2))
-                output1, output2 = fliplr(output1), fliplr(output2)
-                output_batch += interp(sm(0.5 * output1 + output2))
-
-                del output1, output2, inputs2
-
-                heatmap_batch = torch.sum(torch.ones_like(output_batch), dim=1).cpu().data.numpy()
-                output_batch = output_batch.cpu().data.numpy()
-        elif args.model == 'DeepLabSingle':
-            with torch.no_grad():
-                output = model.extractor(inputs)
-                # noise = sample_unit_vec(output.shape[1:], output.shape[0])
-                # if torch.cuda.is_available():
-                #     noise = noise.cuda()
-                # output_noise = output + args.epsilon * noise
-                output = model.classifier(output)
-                # output_noise = model.classifier(output_noise)
-                # output_noise = interp(sm(output_noise))
-                output_batch = interp(sm(output))
-
-                # heatmap_batch = torch.sum(kl_distance(log_sm(output_noise), sm(output)), dim=1)
-                del output
-
-                output = model(fliplr(inputs))
-                output = fliplr(output)
-                output_batch += interp(sm(output))
-
-                del output, inputs
-
-                output = model(inputs2)
-                output_batch += interp(sm(output))
-                del output
-                output = model(fliplr(inputs2))
-                output = fliplr(output)
-                output_batch += interp(sm(output))
-
-                heatmap_batch = torch.sum(torch.ones_like(output_batch), dim=1).cpu().data.numpy()
-                output_batch = output.cpu().data.numpy()
-        elif args.model == 'DeeplabVGG' or args.model == 'Oracle':
-            output_batch = model(Variable(image).cuda())
-            output_batch = interp(output_batch).cpu().data.numpy()
-
-        # output_batch = output_batch.transpose(0,2,3,1)
-        # output_batch = np.asarray(np.argmax(output_batch, axis=3), dtype=np.uint8)
-        output_batch = output_batch.transpose(0, 2, 3, 1)
-        score_batch = np.max(output_batch, axis=3)
-        output_batch = np.asarray(np.argmax(output_batch, axis=3), dtype=np.uint8)
+    artifacts = args.artifacts.split(',')
+    if 'heatmap' in artifacts and args.model in ('DeeplabVGG', 'Oracle'):
+        print('No heatmap for %s, skipping the heatmap artifact' % args.model)
+        artifacts.remove('heatmap')
+    writer = AsyncWriter(num_workers=args.writer_workers, max_pending=args.writer_queue)
+    if args.store:
+        # mean max-probability over the TTA passes, quantized to uint8
+        num_passes = 1 if args.model in ('DeeplabVGG', 'Oracle') else 2 * len(scales)
+        store = MemmapStoreWriter(store_path(args.store, shard, num_shards), [f['name'] for f in shard_files],
+                                  {'label': ((1024, 2048), 'uint8'), 'conf': ((1024, 2048), 'uint8')},
+                                  meta={'restore_from': args.restore_from, 'scales': scales})
+    manifest_fp = open(manifest, 'a')
+    finished = collections.deque()  # (write results, names) of each batch, in order
+
+    def record_finished(wait=False):
+        while finished and (wait or all(result.ready() for result in finished[0][0])):
+            results, names = finished.popleft()
+            for result in results:
+                result.get()  # raises if the write failed
+            if args.store:
+                store.flush()
+            manifest_fp.write(''.join('%s\n' % n for n in names))
+            manifest_fp.flush()
+
+    tt = time.time()
+    num_images = 0
+    for index, batch in enumerate(testloader):
+        images, _, _, name = batch
+
+        heatmap_batch = None
+        with torch.no_grad():
+            if args.model == 'DeeplabVGG' or args.model == 'Oracle':
+                tta = single_pass(model, images[0].to(device))
+            else:
+                # original and flipped inputs of every scale in one forward each
+                tta, outputs = tta_model([image.to(device) for image in images])
+                if 'heatmap' in artifacts and args.model == 'DeepLab':
+                    output1, output2 = outputs[0]
+                    heatmap_batch = torch.sum(kl_distance(log_sm(output1), sm(output2)), dim=1)
+                    heatmap_batch = heatmap_batch.cpu().data.numpy()
+                elif 'heatmap' in artifacts:
+                    # constant map at label resolution, as before the TTA wrapper
+                    heatmap_batch = np.ones((tta.sum.shape[0],) + tta.out_size, dtype=np.float32)
+                del outputs
+
+            pred_batch, score_batch = tta.argmax_max()
+            del tta
+        output_batch = np.asarray(pred_batch.cpu().numpy(), dtype=np.uint8)
+        if args.store:
+            conf_batch = quantize_conf(score_batch, num_passes).cpu().numpy()
+            for i in range(output_batch.shape[0]):
+                store.write(store_index[name[i]], label=output_batch[i], conf=conf_batch[i])
+        del pred_batch, score_batch
         # output_batch[score_batch<3.2] = 255  #3.2 = 4*0.8
-        for i in range(output_batch.shape[0]):
-            output = output_batch[i, :, :]
-            output_col = colorize_mask(output)
-            output = Image.fromarray(output)
 
+        # queued on the long-lived writer pool, inference goes on with the next batch
+        results = []
+        for i in range(output_batch.shape[0]):
             name_tmp = name[i].split('/')[-1]
             dir_name = name[i].split('/')[-2]
             save_path = args.save + '/' + dir_name
-            # save_path = re.replace(save_path, 'leftImg8bit', 'pseudo')
-            # print(save_path)
-            if not os.path.isdir(save_path):
-                os.mkdir(save_path)
-            output.save('%s/%s' % (save_path, name_tmp))
-            print('%s/%s' % (save_path, name_tmp))
-            output_col.save('%s/%s_color.png' % (save_path, name_tmp.split('.')[0]))
-
-            heatmap_tmp = heatmap_batch[i, :, :] / np.max(heatmap_batch[i, :, :])
-            fig = plt.figure()
-            plt.axis('off')
-            heatmap = plt.imshow(heatmap_tmp, cmap='viridis')
-            fig.colorbar(heatmap)
-            fig.savefig('%s/%s_heatmap.png' % (save_path, name_tmp.split('.')[0]))
-
+            output_base = '%s/%s' % (save_path, name_tmp.split('.')[0])
+            if 'label' in artifacts:
+                results.append(writer.submit(save, (output_batch[i, :, :], '%s/%s' % (save_path, name_tmp))))
+            if 'color' in artifacts:
+                results.append(writer.submit(save_color, (output_batch[i, :, :], '%s_color.png' % output_base)))
+            if 'heatmap' in artifacts:
+                results.append(writer.submit(save_heatmap, (heatmap_batch[i, :, :], '%s_heatmap.png' % output_base)))
+        finished.append((results, list(name)))
+        record_finished()
+
+        num_images += output_batch.shape[0]
+        print('\r>>>>Generating pseudo labels...%04d/%04d %.1f img/s, writer queue %d' % (
+            num_images, len(testset), num_images / (time.time() - tt), writer.depth()), end='')
+
+    writer.close()
+    record_finished(wait=True)
+    manifest_fp.close()
+    if args.store:
+        store.close()
+        print('\nPseudo-label store written to %s' % os.path.abspath(store_path(args.store, shard, num_shards)), end='')
+    print('\n%d pseudo labels in %.1f sec, %.1f img/s' % (num_images, time.time() - tt, num_images / max(time.time() - tt, 1e-6)))
     return args.save
 
 
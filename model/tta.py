@@ -0,0 +1,266 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def _lerp_index(out_len, in_len, device):
+    """Source indices and weights of align_corners=True linear interpolation."""
+    if out_len > 1:
+        src = torch.arange(out_len, dtype=torch.float32, device=device) * ((in_len - 1) / float(out_len - 1))
+    else:
+        src = torch.zeros(1, device=device)
+    index0 = src.floor().long().clamp(max=in_len - 1)
+    index1 = (index0 + 1).clamp(max=in_len - 1)
+    return index0, index1, src - index0.float()
+
+
+class TTAAccumulator(object):
+    """ Sum test-time augmented predictions on the low-resolution output grid.
+
+        add() takes the (N, C, h, w) softmax of one scale or flip; outputs of
+        other scales are bilinearly resized to the grid of the first one
+        before they are summed, so nothing is kept at full resolution. The
+        sum is upsampled once at the end: upsample() returns the full
+        (N, C, H, W) tensor like interp() did, argmax_max() returns the
+        prediction and its score without materializing it, upsampling
+        `band` output rows at a time.
+
+        Example:
+        >>> acc = TTAAccumulator(out_size=(1024, 2048))
+        >>> acc.add(sm(0.5 * output1 + output2))
+        >>> acc.add(fliplr(sm(0.5 * output1_flip + output2_flip)))
+        >>> pred, score = acc.argmax_max()
+    """
+    def __init__(self, out_size=(1024, 2048), band=64):
+        self.out_size = tuple(out_size)
+        self.band = band
+        self.sum = None
+
+    def add(self, prob):
+        if self.sum is None:
+            self.sum = prob.clone()
+            return
+        if prob.shape[2:] != self.sum.shape[2:]:
+            prob = F.interpolate(prob, size=self.sum.shape[2:], mode='bilinear', align_corners=True)
+        self.sum += prob
+
+    def upsample(self):
+        return F.interpolate(self.sum, size=self.out_size, mode='bilinear', align_corners=True)
+
+    def argmax_max(self):
+        H, W = self.out_size
+        h = self.sum.shape[2]
+        # widen first (N x C x h x W is small), then interpolate the rows band by band
+        wide = F.interpolate(self.sum, size=(h, W), mode='bilinear', align_corners=True)
+        row0, row1, frac = _lerp_index(H, h, wide.device)
+        frac = frac.view(1, 1, -1, 1)
+        pred = torch.empty((wide.shape[0], H, W), dtype=torch.long, device=wide.device)
+        score = torch.empty((wide.shape[0], H, W), dtype=wide.dtype, device=wide.device)
+        for start in range(0, H, self.band):
+            end = min(start + self.band, H)
+            top = wide[:, :, row0[start:end]]
+            band = top + (wide[:, :, row1[start:end]] - top) * frac[:, :, start:end]
+            score[:, start:end], pred[:, start:end] = torch.max(band, dim=1)
+        return pred, score
+
+
+def combine_heads(outputs):
+    """0.5 * output1 + output2 for DeeplabMulti, the single output otherwise."""
+    if len(outputs) == 2:
+        return 0.5 * outputs[0] + outputs[1]
+    return outputs[0]
+
+
+def single_pass(model, inputs, out_size=(1024, 2048)):
+    """Accumulator with the softmax of one plain forward, for single-output models such as DeeplabVGG."""
+    acc = TTAAccumulator(out_size=out_size)
+    acc.add(F.softmax(model(inputs), dim=1))
+    return acc
+
+
+def quantize_conf(score, num_passes):
+    """uint8 confidence of an argmax_max() score summed over num_passes softmax outputs."""
+    return torch.clamp(score / num_passes, 0, 1).mul_(255).round_().byte()
+
+
+class TTAWrapper(nn.Module):
+    """ Flip (and scale) test-time augmentation around DeeplabMulti / DeeplabSingle.
+
+        For every scale the original and flipped inputs go through the model
+        as one concatenated batch; the flipped half is flipped back with
+        torch.flip, combined (0.5 * output1 + output2 for two-headed models),
+        passed through softmax and summed in a TTAAccumulator. forward()
+        takes one input per scale, e.g. the list of cityscapesMultiScaleDataSet,
+        or a single tensor that is bilinearly resized to every scale. It
+        returns the accumulator and, for heatmaps, the raw outputs of the
+        first scale, one tuple per flip, already flipped back.
+
+        Example:
+        >>> tta_model = TTAWrapper(model, scales=(1.0, 1.25), flips=(False, True))
+        >>> tta, outputs = tta_model([inputs, inputs2])
+        >>> pred, score = tta.argmax_max()
+    """
+    def __init__(self, model, scales=(1.0,), flips=(False, True), out_size=(1024, 2048)):
+        super(TTAWrapper, self).__init__()
+        self.model = model
+        self.scales = tuple(scales)
+        self.flips = tuple(flips)
+        self.out_size = out_size
+
+    def forward(self, inputs):
+        if torch.is_tensor(inputs):
+            h, w = inputs.shape[2:]
+            inputs = [inputs if scale == 1.0 else
+                      F.interpolate(inputs, size=(int(round(h * scale)), int(round(w * scale))),
+                                    mode='bilinear', align_corners=True) for scale in self.scales]
+        if len(inputs) != len(self.scales):
+            raise ValueError('Expected %d inputs, one per scale, got %d.' % (len(self.scales), len(inputs)))
+
+        acc = TTAAccumulator(out_size=self.out_size)
+        first_outputs = None
+        for image in inputs:
+            batch = torch.cat([torch.flip(image, [3]) if flip else image for flip in self.flips])
+            outputs = self.model(batch)
+            if not isinstance(outputs, (tuple, list)):
+                outputs = (outputs,)
+            chunks = [output.chunk(len(self.flips)) for output in outputs]
+            flip_outputs = []
+            for k, flip in enumerate(self.flips):
+                output = tuple(torch.flip(c[k], [3]) if flip else c[k] for c in chunks)
+                acc.add(F.softmax(combine_heads(output), dim=1))
+                flip_outputs.append(output)
+            if first_outputs is None:
+                first_outputs = flip_outputs
+        return acc, first_outputs
+
+
+def _tile_starts(length, tile, stride):
+    starts = list(range(0, max(length - tile, 0) + 1, stride))
+    if starts[-1] + tile < length:
+        starts.append(length - tile)
+    return starts
+
+
+def _tile_weight(h, w, weight, device):
+    if weight == 'uniform':
+        return torch.ones(h, w, device=device)
+    if weight == 'gaussian':
+        # sigma of a quarter tile, never below 1e-3 so corners still count
+        y = torch.linspace(-2, 2, h, device=device)
+        x = torch.linspace(-2, 2, w, device=device)
+        return torch.exp(-0.5 * (y.view(-1, 1) ** 2 + x.view(1, -1) ** 2)).clamp(min=1e-3)
+    raise ValueError('Unknown tile weight %s, use uniform or gaussian.' % weight)
+
+
+class SlidingWindow(nn.Module):
+    """ Tiled inference: the softmax of overlapping tiles merged on the stride-8 output grid.
+
+        Every image is cut into tile_size tiles (height, width) overlapping
+        by `overlap`; the tiles of all images in the batch are run
+        `tile_batch` at a time, so peak memory depends on the tile, not the
+        frame. Each tile output is resized to the grid points its pixels
+        cover (input pixel 8k is point k) and blended with `weight`
+        ('uniform' or 'gaussian'), giving a (N, C, H / 8 + 1, W / 8 + 1)
+        probability map that feeds a TTAAccumulator like a whole-frame
+        output. Image and tile sizes must be multiples of 8.
+
+        Example:
+        >>> sw = SlidingWindow(model, tile_size=(512, 512), overlap=0.25, tile_batch=4)
+        >>> tta = TTAAccumulator(out_size=(1024, 2048))
+        >>> tta.add(sw(inputs))
+    """
+    def __init__(self, model, tile_size=(512, 512), overlap=0.25, weight='gaussian', tile_batch=4, flips=(False,)):
+        super(SlidingWindow, self).__init__()
+        self.model = model
+        self.tile_size = tuple(tile_size)
+        self.overlap = overlap
+        self.weight = weight
+        self.tile_batch = tile_batch
+        self.flips = tuple(flips)
+        for size in self.tile_size:
+            if size % 8 != 0:
+                raise ValueError('Tile size %s is not a multiple of 8.' % (self.tile_size,))
+
+    def forward(self, inputs):
+        N, _, H, W = inputs.shape
+        if H % 8 != 0 or W % 8 != 0:
+            raise ValueError('Input size %dx%d is not a multiple of 8.' % (W, H))
+        th, tw = min(self.tile_size[0], H), min(self.tile_size[1], W)
+        stride_h = max(8, int(th * (1 - self.overlap)) // 8 * 8)
+        stride_w = max(8, int(tw * (1 - self.overlap)) // 8 * 8)
+        tiles = [(n, y, x) for n in range(N)
+                 for y in _tile_starts(H, th, stride_h) for x in _tile_starts(W, tw, stride_w)]
+
+        gh, gw = th // 8 + 1, tw // 8 + 1
+        weight = _tile_weight(gh, gw, self.weight, inputs.device)
+        prob_sum = None
+        weight_sum = torch.zeros(1, 1, H // 8 + 1, W // 8 + 1, device=inputs.device)
+        for start in range(0, len(tiles), self.tile_batch):
+            chunk = tiles[start:start + self.tile_batch]
+            batch = torch.stack([inputs[n, :, y:y + th, x:x + tw] for n, y, x in chunk])
+            prob = 0
+            for flip in self.flips:
+                outputs = self.model(torch.flip(batch, [3]) if flip else batch)
+                if not isinstance(outputs, (tuple, list)):
+                    outputs = (outputs,)
+                if flip:
+                    outputs = tuple(torch.flip(output, [3]) for output in outputs)
+                prob = prob + F.softmax(combine_heads(outputs), dim=1)
+            prob = F.interpolate(prob, size=(gh, gw), mode='bilinear', align_corners=True) * weight
+            if prob_sum is None:
+                prob_sum = torch.zeros(N, prob.shape[1], H // 8 + 1, W // 8 + 1, device=inputs.device)
+            for k, (n, y, x) in enumerate(chunk):
+                prob_sum[n, :, y // 8:y // 8 + gh, x // 8:x // 8 + gw] += prob[k]
+                if n == 0:
+                    weight_sum[0, 0, y // 8:y // 8 + gh, x // 8:x // 8 + gw] += weight
+        return prob_sum / weight_sum
+
+
+def benchmark(batch_size=2, num_classes=19, grid=(65, 129), out_size=(1024, 2048), scales=(1.0, 1.25)):
+    import time
+    # network outputs of different scales see the same scene, draw them from one smooth field
+    logits = 4 * torch.randn(batch_size, num_classes, grid[0] // 4, grid[1] // 4)
+    probs = [torch.softmax(F.interpolate(logits, size=(int(round(grid[0] * s)), int(round(grid[1] * s))),
+                                         mode='bilinear', align_corners=True), dim=1) for s in scales]
+
+    tt = time.time()
+    full = 0
+    for prob in probs:
+        full = full + F.interpolate(prob, size=out_size, mode='bilinear', align_corners=True)
+    score_ref, pred_ref = torch.max(full, dim=1)
+    full_time = time.time() - tt
+
+    tt = time.time()
+    acc = TTAAccumulator(out_size=out_size)
+    for prob in probs:
+        acc.add(prob)
+    pred, score = acc.argmax_max()
+    tta_time = time.time() - tt
+
+    print('%d scales: full resolution %.2f sec, %.0f MB sum; low resolution %.2f sec, %.1f MB sum; argmax agreement %.4f' % (
+        len(scales), full_time, full.numel() * 4 / 2 ** 20, tta_time, acc.sum.numel() * 4 / 2 ** 20,
+        (pred == pred_ref).float().mean().item()))
+
+
+def check_conf(num_classes=19, size=(64, 128)):
+    # DeeplabVGG returns logits, the stored confidence must still be a probability
+    from model.deeplab_vgg import DeeplabVGG
+    model = DeeplabVGG(num_classes=num_classes).eval()
+    for conv in model.classifier.conv2d_list:  # spread the logits so the confidence is not uniform
+        conv.weight.data.normal_(0, 1)
+    inputs = torch.randn(1, 3, size[0], size[1])
+    with torch.no_grad():
+        acc = single_pass(model, inputs, out_size=size)
+        pred, score = acc.argmax_max()
+        conf = quantize_conf(score, 1)
+        reference = F.interpolate(F.softmax(model(inputs), dim=1), size=size, mode='bilinear', align_corners=True)
+    max_prob, argmax = torch.max(reference, dim=1)
+    assert torch.equal(pred, argmax)
+    assert torch.equal(conf, (max_prob * 255).round().byte())
+    print('DeeplabVGG conf check passed, conf %d..%d' % (conf.min().item(), conf.max().item()))
+
+
+if __name__ == '__main__':
+    check_conf()
+    benchmark(scales=(1.0,))
+    benchmark()
@@ -14,15 +14,22 @@ import os
 import os.path as osp
 import random
 import time
+import copy
 import yaml
 from tensorboardX import SummaryWriter
 
 # from trainer_sr_multi import AD_Trainer
 from trainer_sr_multi_variance import AD_Trainer
 from utils.loss import CrossEntropy2d
-from utils.tool import adjust_learning_rate, adjust_learning_rate_D, Timer
+from utils.tool import adjust_learning_rate, adjust_learning_rate_D, Timer, resume_snapshot, save_optimizers
+from utils.prefetcher import DevicePrefetcher
 from dataset.cityscapes_dataset import cityscapesDataSet
 from dataset.cityscapes_pseudo_dataset import cityscapes_pseudo_DataSet
+from dataset.sampler import InfiniteSampler, PairedDataset, PairedSampler
+from dataset.cityscapes_multiscale_dataset import cityscapesMultiScaleDataSet
+from dataset.label_cache import SharedLabelCache
+from utils.optim_weight_ema import EMAWeightOptimizer
+from utils.online_label import OnlineRelabeler
 
 IMG_MEAN = np.array((104.00698793, 116.66876762, 122.67891434), dtype=np.float32)
 
@@ -56,6 +63,11 @@ SAVE_NUM_IMAGES = 2
 SAVE_PRED_EVERY = 5000
 SNAPSHOT_DIR = './snapshots/'
 THRESHOLD = 1.0
+EMA_ALPHA = 0.999
+RELABEL_EVERY = 2000
+RELABEL_SIZE = 500
+ONLINE_LABEL_SIZE = '2048,1024'
+RELABEL_SCALES = '1.0,1.25'
 WEIGHT_DECAY = 0.0005
 WARM_UP = 0 # no warmup
 LOG_DIR = './log'
@@ -96,6 +108,10 @@ def get_arguments():
                         help="Accumulate gradients for ITER_SIZE iterations.")
     parser.add_argument("--num-workers", type=int, default=NUM_WORKERS,
                         help="number of workers for multithread dataloading.")
+    parser.add_argument("--uint8-loader", action='store_true',
+                        help="workers return uint8 crops, normalization runs once per batch on the GPU.")
+    parser.add_argument("--crop-first", action='store_true',
+                        help="pick the crop first and resize only the image region under it.")
     parser.add_argument("--data-dir", type=str, default=DATA_DIRECTORY,
                         help="Path to the directory containing the source dataset.")
     parser.add_argument("--data-list", type=str, default=DATA_LIST_PATH,
@@ -144,6 +160,8 @@ def get_arguments():
                         help="Number of training steps.")
     parser.add_argument("--num-steps-stop", type=int, default=NUM_STEPS_STOP,
                         help="Number of training steps for early stopping.")
+    parser.add_argument("--start-step", type=int, default=0,
+                        help="Resume from the snapshot of this iteration in --snapshot-dir (weights and optimizer state) and continue with the next one.")
     parser.add_argument("--power", type=float, default=POWER,
                         help="Decay parameter to compute the learning rate.")
     parser.add_argument("--random-mirror", action="store_true",
@@ -166,6 +184,21 @@ def get_arguments():
                         help="Regularisation parameter for L2-loss.")
     parser.add_argument("--warm-up", type=float, default=WARM_UP, help = 'warm up iteration')
     parser.add_argument("--threshold", type=float, default=THRESHOLD, help = 'warm up iteration')
+    parser.add_argument("--pseudo-store", type=str, default='',
+                        help="Memory-mapped pseudo-label store of generate_plabel_cityscapes.py --store, thresholded at load time.")
+    parser.add_argument("--online-label", action='store_true',
+                        help="Relabel the training images during training with an EMA teacher, replacing the offline pseudo labels.")
+    parser.add_argument("--ema-alpha", type=float, default=EMA_ALPHA,
+                        help="EMA decay of the teacher weights.")
+    parser.add_argument("--relabel-every", type=int, default=RELABEL_EVERY,
+                        help="Start a relabeling round every this many iterations.")
+    parser.add_argument("--relabel-size", type=int, default=RELABEL_SIZE,
+                        help="Number of images relabeled per round, taken in turn from the training list.")
+    parser.add_argument("--online-label-size", type=str, default=ONLINE_LABEL_SIZE,
+                        help="Comma-separated width,height of the online labels kept in shared memory, "
+                             "full resolution like generate_plabel_cityscapes.py by default (~6 GB for 2975 images).")
+    parser.add_argument("--relabel-scales", type=str, default=RELABEL_SCALES,
+                        help="Comma-separated test-time scales of the teacher, the same as generate_plabel_cityscapes.py by default.")
     parser.add_argument("--cpu", action='store_true', help="choose to use cpu device.")
     parser.add_argument("--class-balance", action='store_true', help="class balance.")
     parser.add_argument("--use-se", action='store_true', help="use se block.")
@@ -237,28 +270,59 @@ def main():
         Trainer = AD_Trainer(args)
 
     print(Trainer)
-
-    trainloader = data.DataLoader(
-        cityscapes_pseudo_DataSet(args.data_dir, args.data_list, max_iters=args.num_steps * args.iter_size * args.batch_size,
-                    resize_size=args.input_size,
-                    crop_size=args.crop_size,
-                    scale=True, mirror=True, mean=IMG_MEAN,
-                    set='train', autoaug = args.autoaug, threshold = args.threshold),
-        batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, pin_memory=True, drop_last=True)
-
-    trainloader_iter = enumerate(trainloader)
-
-    targetloader = data.DataLoader(cityscapesDataSet(args.data_dir_target, args.data_list_target,
-                                                     max_iters=args.num_steps * args.iter_size * args.batch_size,
-                                                     resize_size=args.input_size_target,
-                                                     crop_size=args.crop_size,
-                                                     scale=False, mirror=args.random_mirror, mean=IMG_MEAN,
-                                                     set=args.set, autoaug = args.autoaug_target),
-                                   batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers,
-                                   pin_memory=True, drop_last=True)
-
-
-    targetloader_iter = enumerate(targetloader)
+    # batches (and the relabeler) go to the device the trainer put the generator on
+    device = next(Trainer.G.parameters()).device
+
+    first_step = 0
+    if args.start_step > 0:
+        resume_snapshot(Trainer, osp.join(args.snapshot_dir, 'GTA5_' + str(args.start_step)))
+        first_step = args.start_step + 1
+
+    trainset = cityscapes_pseudo_DataSet(args.data_dir, args.data_list,
+                                         resize_size=args.input_size,
+                                         crop_size=args.crop_size,
+                                         scale=True, mirror=True, mean=IMG_MEAN,
+                                         set='train', autoaug = args.autoaug, return_uint8=args.uint8_loader, crop_first=args.crop_first, threshold = args.threshold,
+                                         pseudo_store=args.pseudo_store)
+
+    if args.online_label:
+        # the teacher follows the student by EMA; its labels replace the offline ones image by image
+        G = Trainer.G.module if args.multi_gpu else Trainer.G
+        teacher = copy.deepcopy(G)
+        teacher.eval()
+        for param in teacher.parameters():
+            param.requires_grad = False
+        ema = EMAWeightOptimizer(teacher, G, alpha=args.ema_alpha)
+        ema_path = osp.join(args.snapshot_dir, 'GTA5_' + str(args.start_step) + '_ema.pth')
+        if args.start_step > 0 and osp.isfile(ema_path):
+            teacher.load_state_dict(torch.load(ema_path, map_location='cpu'))
+        w, h = map(int, args.online_label_size.split(','))
+        # allocated before the loader forks its workers, which then see every update
+        trainset.label_cache = SharedLabelCache(len(trainset.files), size=(h, w))
+        # same input size, scales and flips as generate_plabel_cityscapes.py, so confidences compare
+        relabel_scales = [float(scale) for scale in args.relabel_scales.split(',')]
+        relabelset = cityscapesMultiScaleDataSet(args.data_dir, args.data_list, scales=relabel_scales,
+                                                 resize_size=(1024, 512), mean=IMG_MEAN, set='train')
+        relabeler = OnlineRelabeler(teacher, relabelset, trainset.label_cache, subset_size=args.relabel_size,
+                                    threshold=args.threshold, scales=relabel_scales, device=device)
+    targetset = cityscapesDataSet(args.data_dir_target, args.data_list_target,
+                                  resize_size=args.input_size_target,
+                                  crop_size=args.crop_size,
+                                  scale=False, mirror=args.random_mirror, mean=IMG_MEAN,
+                                  set=args.set, autoaug = args.autoaug_target,
+                                  return_uint8=args.uint8_loader, crop_first=args.crop_first)
+
+    # one worker pool and prefetch queue for both domains
+    start_index = first_step * args.iter_size * args.batch_size
+    pairedloader = data.DataLoader(
+        PairedDataset(trainset, targetset), batch_size=args.batch_size,
+        sampler=PairedSampler(InfiniteSampler(len(trainset), seed=args.random_seed, start_index=start_index),
+                              InfiniteSampler(len(targetset), seed=args.random_seed + 1, start_index=start_index)),
+        num_workers=args.num_workers, pin_memory=True, drop_last=True)
+
+    # stages the next batch on the GPU while the current step runs
+    pairedloader_iter = DevicePrefetcher(pairedloader, device,
+                                         mean=IMG_MEAN if args.uint8_loader else None)
 
     # set up tensor board
     if args.tensorboard:
@@ -268,7 +332,7 @@ def main():
 
         writer = SummaryWriter(args.log_dir)
 
-    for i_iter in range(args.num_steps):
+    for i_iter in range(first_step, args.num_steps):
 
         loss_seg_value1 = 0
         loss_adv_target_value1 = 0
@@ -290,15 +354,10 @@ def main():
 
             # train with source
 
-            _, batch = trainloader_iter.__next__()
-            _, batch_t = targetloader_iter.__next__()
+            batch, batch_t = next(pairedloader_iter)
 
             images, labels, _, _ = batch
-            images = images.cuda()
-            labels = labels.long().cuda()
             images_t, labels_t, _, _ = batch_t
-            images_t = images_t.cuda()
-            labels_t = labels_t.long().cuda()
 
             with Timer("Elapsed time in update: %f"):
                 loss_seg1, loss_seg2, loss_adv_target1, loss_adv_target2, loss_kl1, loss_kl2, pred1, \
@@ -321,6 +380,11 @@ def main():
 
         del pred1, pred2, pred_target1, pred_target2, pred_target_noise1, pred_target_noise2
 
+        if args.online_label:
+            ema.step()
+            if (i_iter + 1) % args.relabel_every == 0 and not relabeler.refresh(teacher):
+                print('Relabeling round still running, skipped')
+
         if args.tensorboard:
             scalar_info = {
                 'loss_seg1': loss_seg_value1,
@@ -340,9 +404,9 @@ def main():
 
         print('exp = {}'.format(args.snapshot_dir))
         print(
-            '\033[1m iter = %8d/%8d \033[0m loss_seg1 = %.3f loss_seg2 = %.3f loss_kl1 = %.3f  loss_kl2 = %.3f loss_adv1 = %.3f, loss_adv2 = %.3f loss_D1 = %.3f loss_D2 = %.3f, val_loss=%.3f' % (
+            '\033[1m iter = %8d/%8d \033[0m loss_seg1 = %.3f loss_seg2 = %.3f loss_kl1 = %.3f  loss_kl2 = %.3f loss_adv1 = %.3f, loss_adv2 = %.3f loss_D1 = %.3f loss_D2 = %.3f, val_loss=%.3f data_wait=%.3fs' % (
             i_iter, args.num_steps, loss_seg_value1, loss_seg_value2, loss_kl_target_value1, loss_kl_target_value2, loss_adv_target_value1,
-            loss_adv_target_value2, loss_D_value1, loss_D_value2, val_loss))
+            loss_adv_target_value2, loss_D_value1, loss_D_value2, val_loss, pairedloader_iter.pop_wait_time()))
 
         # clear loss
         del loss_seg1, loss_seg2, loss_adv_target1, loss_adv_target2, loss_kl1, loss_kl2, val_loss
@@ -359,8 +423,11 @@ def main():
         if i_iter % args.save_pred_every == 0 and i_iter != 0:
             print('taking snapshot ...')
             torch.save(Trainer.G.state_dict(), osp.join(args.snapshot_dir, 'GTA5_' + str(i_iter) + '.pth'))
+            save_optimizers(Trainer, osp.join(args.snapshot_dir, 'GTA5_' + str(i_iter) + '_opt.pth'))
             torch.save(Trainer.D1.state_dict(), osp.join(args.snapshot_dir, 'GTA5_' + str(i_iter) + '_D1.pth'))
             torch.save(Trainer.D2.state_dict(), osp.join(args.snapshot_dir, 'GTA5_' + str(i_iter) + '_D2.pth'))
+            if args.online_label:
+                torch.save(teacher.state_dict(), osp.join(args.snapshot_dir, 'GTA5_' + str(i_iter) + '_ema.pth'))
 
     if args.tensorboard:
         writer.close()
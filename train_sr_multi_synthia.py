@@ -19,9 +19,11 @@ from tensorboardX import SummaryWriter
 
 from trainer_sr_multi import AD_Trainer
 from utils.loss import CrossEntropy2d
-from utils.tool import adjust_learning_rate, adjust_learning_rate_D, Timer
+from utils.tool import adjust_learning_rate, adjust_learning_rate_D, Timer, resume_snapshot, save_optimizers
+from utils.prefetcher import DevicePrefetcher
 from dataset.synthia_dataset import SynthiaDataSet
 from dataset.cityscapes_dataset import cityscapesDataSet
+from dataset.sampler import InfiniteSampler, PairedDataset, PairedSampler
 
 IMG_MEAN = np.array((104.00698793, 116.66876762, 122.67891434), dtype=np.float32)
 
@@ -94,6 +96,10 @@ def get_arguments():
                         help="Accumulate gradients for ITER_SIZE iterations.")
     parser.add_argument("--num-workers", type=int, default=NUM_WORKERS,
                         help="number of workers for multithread dataloading.")
+    parser.add_argument("--uint8-loader", action='store_true',
+                        help="workers return uint8 crops, normalization runs once per batch on the GPU.")
+    parser.add_argument("--crop-first", action='store_true',
+                        help="pick the crop first and resize only the image region under it.")
     parser.add_argument("--data-dir", type=str, default=DATA_DIRECTORY,
                         help="Path to the directory containing the source dataset.")
     parser.add_argument("--data-list", type=str, default=DATA_LIST_PATH,
@@ -146,6 +152,8 @@ def get_arguments():
                         help="Number of training steps.")
     parser.add_argument("--num-steps-stop", type=int, default=NUM_STEPS_STOP,
                         help="Number of training steps for early stopping.")
+    parser.add_argument("--start-step", type=int, default=0,
+                        help="Resume from the snapshot of this iteration in --snapshot-dir (weights and optimizer state) and continue with the next one.")
     parser.add_argument("--power", type=float, default=POWER,
                         help="Decay parameter to compute the learning rate.")
     parser.add_argument("--random-mirror", action="store_true",
@@ -175,6 +183,8 @@ def get_arguments():
     parser.add_argument("--train_bn", action='store_true', help="train batch normalization.")
     parser.add_argument("--sync_bn", action='store_true', help="sync batch normalization.")
     parser.add_argument("--often-balance", action='store_true', help="balance the apperance times.")
+    parser.add_argument("--fused-target", action='store_true',
+                        help="Compute the adversarial and KL target losses from one backbone pass with one optimizer step.")
     parser.add_argument("--gpu-ids", type=str, default='0', help='choose gpus')
     parser.add_argument("--tensorboard", action='store_false', help="choose whether to use tensorboard.")
     parser.add_argument("--log-dir", type=str, default=LOG_DIR,
@@ -233,26 +243,36 @@ def main():
         Trainer = AD_Trainer(args)
 
     print(Trainer)
-
-    trainloader = data.DataLoader(
-        SynthiaDataSet(args.data_dir, args.data_list, max_iters=args.num_steps * args.iter_size * args.batch_size,
-                    resize_size=args.input_size,
-                    crop_size=args.crop_size,
-                    scale=True, mirror=True, mean=IMG_MEAN, autoaug=args.autoaug),
-        batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, pin_memory=True, drop_last=True)
-
-    trainloader_iter = enumerate(trainloader)
-
-    targetloader = data.DataLoader(cityscapesDataSet(args.data_dir_target, args.data_list_target,
-                                                     max_iters=args.num_steps * args.iter_size * args.batch_size,
-                                                     resize_size=args.input_size_target,
-                                                     crop_size=args.crop_size,
-                                                     scale=False, mirror=args.random_mirror, mean=IMG_MEAN,
-                                                     set=args.set, autoaug=args.autoaug_target),
-                                   batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers,
-                                   pin_memory=True, drop_last=True)
-
-    targetloader_iter = enumerate(targetloader)
+    # batches (and the relabeler) go to the device the trainer put the generator on
+    device = next(Trainer.G.parameters()).device
+
+    first_step = 0
+    if args.start_step > 0:
+        resume_snapshot(Trainer, osp.join(args.snapshot_dir, 'synthia_' + str(args.start_step)))
+        first_step = args.start_step + 1
+
+    trainset = SynthiaDataSet(args.data_dir, args.data_list,
+                              resize_size=args.input_size,
+                              crop_size=args.crop_size,
+                              scale=True, mirror=True, mean=IMG_MEAN, autoaug=args.autoaug, return_uint8=args.uint8_loader, crop_first=args.crop_first)
+    targetset = cityscapesDataSet(args.data_dir_target, args.data_list_target,
+                                  resize_size=args.input_size_target,
+                                  crop_size=args.crop_size,
+                                  scale=False, mirror=args.random_mirror, mean=IMG_MEAN,
+                                  set=args.set, autoaug=args.autoaug_target,
+                                  return_uint8=args.uint8_loader, crop_first=args.crop_first)
+
+    # one worker pool and prefetch queue for both domains
+    start_index = first_step * args.iter_size * args.batch_size
+    pairedloader = data.DataLoader(
+        PairedDataset(trainset, targetset), batch_size=args.batch_size,
+        sampler=PairedSampler(InfiniteSampler(len(trainset), seed=args.random_seed, start_index=start_index),
+                              InfiniteSampler(len(targetset), seed=args.random_seed + 1, start_index=start_index)),
+        num_workers=args.num_workers, pin_memory=True, drop_last=True)
+
+    # stages the next batch on the GPU while the current step runs
+    pairedloader_iter = DevicePrefetcher(pairedloader, device,
+                                         mean=IMG_MEAN if args.uint8_loader else None)
 
     # set up tensor board
     if args.tensorboard:
@@ -262,7 +282,7 @@ def main():
 
         writer = SummaryWriter(args.log_dir)
 
-    for i_iter in range(args.num_steps):
+    for i_iter in range(first_step, args.num_steps):
 
         loss_seg_value1 = 0
         loss_adv_target_value1 = 0
@@ -284,15 +304,10 @@ def main():
 
             # train with source
 
-            _, batch = trainloader_iter.__next__()
-            _, batch_t = targetloader_iter.__next__()
+            batch, batch_t = next(pairedloader_iter)
 
             images, labels, _, _ = batch
-            images = images.cuda()
-            labels = labels.long().cuda()
             images_t, labels_t, _, _ = batch_t
-            images_t = images_t.cuda()
-            labels_t = labels_t.long().cuda()
 
             with Timer("Elapsed time in update: %f"):
                 loss_seg1, loss_seg2, loss_adv_target1, loss_adv_target2, loss_kl1, loss_kl2, pred1, \
@@ -334,9 +349,9 @@ def main():
 
         print('exp = {}'.format(args.snapshot_dir))
         print(
-            '\033[1m iter = %8d/%8d \033[0m loss_seg1 = %.3f loss_seg2 = %.3f loss_kl1 = %.3f  loss_kl2 = %.3f loss_adv1 = %.3f, loss_adv2 = %.3f loss_D1 = %.3f loss_D2 = %.3f, val_loss=%.3f' % (
+            '\033[1m iter = %8d/%8d \033[0m loss_seg1 = %.3f loss_seg2 = %.3f loss_kl1 = %.3f  loss_kl2 = %.3f loss_adv1 = %.3f, loss_adv2 = %.3f loss_D1 = %.3f loss_D2 = %.3f, val_loss=%.3f data_wait=%.3fs' % (
             i_iter, args.num_steps, loss_seg_value1, loss_seg_value2, loss_kl_target_value1, loss_kl_target_value2, loss_adv_target_value1,
-            loss_adv_target_value2, loss_D_value1, loss_D_value2, val_loss))
+            loss_adv_target_value2, loss_D_value1, loss_D_value2, val_loss, pairedloader_iter.pop_wait_time()))
 
         # clear loss
         del loss_seg1, loss_seg2, loss_adv_target1, loss_adv_target2, loss_kl1, loss_kl2, val_loss
@@ -353,6 +368,7 @@ def main():
         if i_iter % args.save_pred_every == 0 and i_iter != 0:
             print('taking snapshot ...')
             torch.save(Trainer.G.state_dict(), osp.join(args.snapshot_dir, 'synthia_' + str(i_iter) + '.pth'))
+            save_optimizers(Trainer, osp.join(args.snapshot_dir, 'synthia_' + str(i_iter) + '_opt.pth'))
             torch.save(Trainer.D1.state_dict(), osp.join(args.snapshot_dir, 'synthia_' + str(i_iter) + '_D1.pth'))
             torch.save(Trainer.D2.state_dict(), osp.join(args.snapshot_dir, 'synthia_' + str(i_iter) + '_D2.pth'))
 
@@ -84,6 +84,7 @@ class AD_Trainer(nn.Module):
         self.often_weight = torch.FloatTensor(self.num_classes).zero_().cuda() + 1
         self.multi_gpu = args.multi_gpu
         self.only_hard_label = args.only_hard_label
+        self.fused_target = args.fused_target
         if args.model == 'DeepLabMulti':
             self.G = DeeplabMulti(num_classes=args.num_classes, use_se=args.use_se, train_bn=args.train_bn,
                                   norm_style=args.norm_style, droprate=args.droprate, arch=args.arch)
@@ -213,6 +214,13 @@ class AD_Trainer(nn.Module):
             loss.backward()
         self.gen_opt.step()
 
+        if self.fused_target:
+            loss_adv_target1, loss_adv_target2, loss_kl1, loss_kl2, pred_target1, pred_target2, \
+            pred_target_noise1, pred_target_noise2 = self.target_update_fused(images_t)
+            val_loss = self.seg_loss(pred_target2, labels_t)
+            return loss_seg1, loss_seg2, loss_adv_target1, loss_adv_target2, loss_kl1, loss_kl2, pred1, pred2, \
+                   pred_target1, pred_target2, pred_target_noise1, pred_target_noise2, val_loss
+
         # target
         self.gen_opt.zero_grad()
         loss_adv_target1 = torch.tensor(0.0)
@@ -292,6 +300,49 @@ class AD_Trainer(nn.Module):
         return loss_seg1, loss_seg2, loss_adv_target1, loss_adv_target2, loss_kl1, loss_kl2, pred1, pred2, \
                pred_target1, pred_target2, pred_target_noise1, pred_target_noise2, val_loss
 
+    def target_update_fused(self, images_t):
+        """Adversarial and KL target losses from one backbone pass, with one backward and one step."""
+        self.gen_opt.zero_grad()
+        G = self.G.module if self.multi_gpu else self.G
+        D1 = self.D1.module if self.multi_gpu else self.D1
+        D2 = self.D2.module if self.multi_gpu else self.D2
+
+        feature1, feature2 = self.G(images_t, inter=True)
+        noise1 = sample_unit_vec(feature1.shape[1:], feature1.shape[0])
+        noise2 = sample_unit_vec(feature2.shape[1:], feature2.shape[0])
+        if torch.cuda.is_available():
+            noise1, noise2 = noise1.cuda(), noise2.cuda()
+        # the clean heads feed both the discriminators and the KL target
+        pred_target1 = self.interp_target(G.layer5(feature1))
+        pred_target2 = self.interp_target(G.layer6(feature2))
+        pred_target_noise1 = self.interp_target(G.layer5(feature1 + self.epsilon1 * noise1))
+        pred_target_noise2 = self.interp_target(G.layer6(feature2 + self.epsilon2 * noise2))
+
+        loss = 0
+        loss_adv_target1 = torch.tensor(0.0)
+        loss_adv_target2 = torch.tensor(0.0)
+        if self.lambda_adv_target1 > 0 or self.lambda_adv_target2 > 0:
+            loss_adv_target1 = D1.calc_gen_loss(self.D1, input_fake=F.softmax(pred_target1, dim=1))
+            loss_adv_target2 = D2.calc_gen_loss(self.D2, input_fake=F.softmax(pred_target2, dim=1))
+            loss_adv_gen = self.lambda_adv_target1 * loss_adv_target1 + self.lambda_adv_target2 * loss_adv_target2
+            print('Adv Gen Loss: ', loss_adv_gen.item())
+            loss = loss + loss_adv_gen
+
+        n, c, h, w = pred_target1.shape
+        loss_kl1 = self.lambda_kl_target1 * (self.kl_loss(self.log_sm(pred_target_noise1), self.sm(pred_target1))) / (n * h * w)
+        loss_kl2 = self.lambda_kl_target2 * (self.kl_loss(self.log_sm(pred_target_noise2), self.sm(pred_target2))) / (n * h * w)
+        print('KL loss: ', (loss_kl1 + loss_kl2).item())
+        loss = loss + loss_kl1 + loss_kl2
+
+        if self.fp16:
+            with amp.scale_loss(loss, self.gen_opt) as scaled_loss:
+                scaled_loss.backward()
+        else:
+            loss.backward()
+        self.gen_opt.step()
+        return loss_adv_target1, loss_adv_target2, loss_kl1, loss_kl2, pred_target1, pred_target2, \
+               pred_target_noise1, pred_target_noise2
+
     def dis_update(self, pred1, pred2, pred_target1, pred_target2):
         self.dis1_opt.zero_grad()
         self.dis2_opt.zero_grad()
@@ -0,0 +1,57 @@
+import collections
+import time
+from multiprocessing import Pool
+
+
+class AsyncWriter(object):
+    """ Long-lived process pool that writes outputs while inference keeps running.
+
+        submit() hands a picklable function and its argument to the pool and
+        returns its AsyncResult at once; only when `max_pending` jobs are in
+        flight does it wait for the oldest one, which bounds the memory held
+        by queued arrays. Errors raised in a worker surface on the next wait.
+        close() drains the queue and prints how often and how long submit()
+        blocked.
+
+        Example:
+        >>> writer = AsyncWriter(num_workers=4, max_pending=32)
+        >>> writer.submit(save, (output, name))
+        >>> writer.close()
+    """
+    def __init__(self, num_workers=4, max_pending=32):
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self.pool = Pool(num_workers)
+        self.pending = collections.deque()
+        self.num_jobs = 0
+        self.num_waits = 0
+        self.wait_time = 0.0
+        self.max_depth = 0
+
+    def submit(self, fn, arg):
+        while len(self.pending) >= self.max_pending:
+            tt = time.time()
+            self.pending.popleft().get()
+            self.num_waits += 1
+            self.wait_time += time.time() - tt
+        # drop finished jobs so the depth reflects the real backlog
+        while self.pending and self.pending[0].ready():
+            self.pending.popleft().get()
+        result = self.pool.apply_async(fn, (arg,))
+        self.pending.append(result)
+        self.num_jobs += 1
+        self.max_depth = max(self.max_depth, len(self.pending))
+        return result
+
+    def depth(self):
+        return len(self.pending)
+
+    def close(self):
+        tt = time.time()
+        while self.pending:
+            self.pending.popleft().get()
+        self.pool.close()
+        self.pool.join()
+        print('Writer: %d jobs on %d workers, max queue depth %d/%d, blocked %d times for %.1f sec, drained in %.1f sec'
+              % (self.num_jobs, self.num_workers, self.max_depth, self.max_pending,
+                 self.num_waits, self.wait_time, time.time() - tt))
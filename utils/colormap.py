@@ -0,0 +1,112 @@
+import numpy as np
+from PIL import Image
+
+# matplotlib's viridis sampled at 256 levels, as RGB bytes
+_VIRIDIS_HEX = (
+    '44015444025645045745055946075a46085c460a5d460b5e470d60470e61471063471164471365481467481668481769'
+    '48186a481a6c481b6d481c6e481d6f481f70482071482173482374482475482576482677482878482979472a7a472c7a'
+    '472d7b472e7c472f7d46307e46327e46337f463480453581453781453882443983443a83443b84433d84433e85423f85'
+    '4240864241864142874144874045884046883f47883f48893e49893e4a893e4c8a3d4d8a3d4e8a3c4f8a3c508b3b518b'
+    '3b528b3a538b3a548c39558c39568c38588c38598c375a8c375b8d365c8d365d8d355e8d355f8d34608d34618d33628d'
+    '33638d32648e32658e31668e31678e31688e30698e306a8e2f6b8e2f6c8e2e6d8e2e6e8e2e6f8e2d708e2d718e2c718e'
+    '2c728e2c738e2b748e2b758e2a768e2a778e2a788e29798e297a8e297b8e287c8e287d8e277e8e277f8e27808e26818e'
+    '26828e26828e25838e25848e25858e24868e24878e23888e23898e238a8d228b8d228c8d228d8d218e8d218f8d21908d'
+    '21918c20928c20928c20938c1f948c1f958b1f968b1f978b1f988b1f998a1f9a8a1e9b8a1e9c891e9d891f9e891f9f88'
+    '1fa0881fa1881fa1871fa28720a38620a48621a58521a68522a78522a88423a98324aa8325ab8225ac8226ad8127ad81'
+    '28ae8029af7f2ab07f2cb17e2db27d2eb37c2fb47c31b57b32b67a34b67935b77937b87838b9773aba763bbb753dbc74'
+    '3fbc7340bd7242be7144bf7046c06f48c16e4ac16d4cc26c4ec36b50c46a52c56954c56856c66758c7655ac8645cc863'
+    '5ec96260ca6063cb5f65cb5e67cc5c69cd5b6ccd5a6ece5870cf5773d05675d05477d1537ad1517cd2507fd34e81d34d'
+    '84d44b86d54989d5488bd6468ed64590d74393d74195d84098d83e9bd93c9dd93ba0da39a2da37a5db36a8db34aadc32'
+    'addc30b0dd2fb2dd2db5de2bb8de29bade28bddf26c0df25c2df23c5e021c8e020cae11fcde11dd0e11cd2e21bd5e21a'
+    'd8e219dae319dde318dfe318e2e418e5e419e7e419eae51aece51befe51cf1e51df4e61ef6e620f8e621fbe723fde725'
+)
+VIRIDIS = np.frombuffer(bytes.fromhex(_VIRIDIS_HEX), dtype=np.uint8).reshape(256, 3)
+
+
+def colormap_index(x, num_colors=256):
+    """ Bin a float HxW array into uint8 color indices, min-max normalized like plt.imshow.
+
+        NaNs and constant maps fall back to the first color.
+    """
+    x = np.asarray(x, dtype=np.float32)
+    finite = np.isfinite(x)
+    if not finite.all():
+        x = np.where(finite, x, np.nan)
+        if not finite.any():
+            return np.zeros(x.shape, dtype=np.uint8)
+    vmin, vmax = np.nanmin(x), np.nanmax(x)
+    scale = num_colors / (vmax - vmin) if vmax > vmin else 0.0
+    index = np.subtract(x, vmin, dtype=np.float32)
+    index *= scale
+    np.clip(index, 0, num_colors - 1, out=index)
+    index[np.isnan(index)] = 0
+    return index.astype(np.uint8)
+
+
+def apply_colormap(x, lut=VIRIDIS):
+    """Map a float HxW array to HxWx3 uint8 colors."""
+    return np.take(lut, colormap_index(x, len(lut)), axis=0)
+
+
+def save_colormap(x, path, lut=VIRIDIS):
+    """ Write a float map as a colored PNG at its own resolution, without figure or colorbar.
+
+        The PNG is palette based, one byte per pixel with `lut` as palette.
+        Most of the time goes to PNG encoding, not to the color mapping.
+    """
+    image = Image.fromarray(colormap_index(x, len(lut)), mode='L').convert('P')
+    image.putpalette(lut.tobytes())
+    image.save(path)
+
+
+def benchmark(shape=(1024, 2048), repeat=5):
+    import time
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    # heatmaps are upsampled network outputs, smooth rather than pixel noise
+    x = np.random.rand(shape[0] // 8, shape[1] // 8).astype(np.float32)
+    x = np.kron(x, np.ones((8, 8), dtype=np.float32))
+
+    # the mapping alone: matplotlib Normalize + colormap to bytes against the lut
+    tt = time.time()
+    for _ in range(repeat):
+        reference = (plt.get_cmap('viridis')(plt.Normalize()(x))[:, :, :3] * 255 + 0.5).astype(np.uint8)
+    plt_map_time = (time.time() - tt) / repeat
+
+    tt = time.time()
+    for _ in range(repeat):
+        colors = apply_colormap(x)
+    lut_map_time = (time.time() - tt) / repeat
+
+    # writing the file: the old figure with imshow against the palette PNG, which is bound by PNG encoding
+    tt = time.time()
+    for _ in range(repeat):
+        fig = plt.figure()
+        plt.axis('off')
+        plt.imshow(x, cmap='viridis')
+        fig.savefig('/tmp/colormap_plt.png')
+        plt.close(fig)
+    plt_save_time = (time.time() - tt) / repeat
+
+    tt = time.time()
+    for _ in range(repeat):
+        save_colormap(x, '/tmp/colormap_lut.png')
+    lut_save_time = (time.time() - tt) / repeat
+
+    index = Image.fromarray(colormap_index(x), mode='L')
+    tt = time.time()
+    for _ in range(repeat):
+        index.save('/tmp/colormap_index.png')
+    encode_time = (time.time() - tt) / repeat
+
+    print('%dx%d map, mapping: matplotlib %.1f ms, lut %.1f ms, speedup %.1fx, max color error %d' % (
+        shape[1], shape[0], plt_map_time * 1000, lut_map_time * 1000, plt_map_time / lut_map_time,
+        np.abs(reference.astype(int) - colors).max()))
+    print('%dx%d map, saving: matplotlib figure %.1f ms, palette png %.1f ms (png encoding alone %.1f ms), '
+          'speedup %.1fx' % (shape[1], shape[0], plt_save_time * 1000, lut_save_time * 1000, encode_time * 1000,
+                             plt_save_time / lut_save_time))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,53 @@
+import numpy as np
+import time
+
+
+def build_lut(mapping, num_entries=256, fill=255, dtype=np.uint8):
+    """ Build a lookup table that remaps raw label ids to train ids.
+
+        mapping: {id: train_id} dict or a list of [id, train_id] pairs.
+        num_entries: 256 for 8-bit labels, 65536 for 16-bit labels.
+        fill: value of ids missing from mapping, None keeps them unchanged.
+    """
+    if fill is None:
+        lut = np.arange(num_entries).astype(dtype)
+    else:
+        lut = np.full(num_entries, fill, dtype=dtype)
+    items = mapping.items() if isinstance(mapping, dict) else mapping
+    for k, v in items:
+        if 0 <= k < num_entries:
+            lut[k] = v
+    return lut
+
+
+def map_labels(label, lut):
+    """Remap a label map with a single fancy-index into lut."""
+    return lut[np.asarray(label)]
+
+
+def benchmark(shape=(1024, 2048), repeat=20):
+    id_to_trainid = {7: 0, 8: 1, 11: 2, 12: 3, 13: 4, 17: 5,
+                     19: 6, 20: 7, 21: 8, 22: 9, 23: 10, 24: 11, 25: 12,
+                     26: 13, 27: 14, 28: 15, 31: 16, 32: 17, 33: 18}
+    label = np.random.randint(0, 34, size=shape).astype(np.uint8)
+
+    tt = time.time()
+    for _ in range(repeat):
+        label_copy = 255 * np.ones(label.shape, dtype=np.uint8)
+        for k, v in list(id_to_trainid.items()):
+            label_copy[label == k] = v
+    loop_time = (time.time() - tt) / repeat
+
+    tt = time.time()
+    for _ in range(repeat):
+        lut = build_lut(id_to_trainid)
+        label_lut = map_labels(label, lut)
+    lut_time = (time.time() - tt) / repeat
+
+    assert np.array_equal(label_copy, label_lut)
+    print('%dx%d labels: dict loop %.2f ms, lut %.2f ms, speedup %.1fx' % (
+        shape[1], shape[0], loop_time * 1000, lut_time * 1000, loop_time / lut_time))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,179 @@
+import copy
+import threading
+import time
+import torch
+from torch.utils import data
+from model.tta import TTAWrapper
+
+
+class OnlineRelabeler(object):
+    """ Refresh pseudo labels from an EMA teacher in a background thread.
+
+        refresh() copies the teacher weights into a private model and starts
+        a thread that labels the next `subset_size` images of `dataset` (a
+        cityscapesMultiScaleDataSet over the training list with the same
+        `scales`), so the whole list is covered in a rolling window over
+        several rounds. Predictions use flip and scale TTA like
+        generate_plabel_cityscapes.py, and pixels whose mean max-probability
+        over the passes is below `threshold` become 255, so online and
+        offline labels are thresholded alike. Results go to a
+        SharedLabelCache. The loader workers are spawned rather than forked,
+        since forking from the background thread can deadlock. A refresh
+        while the previous round still runs is skipped, and on CUDA the
+        thread works on its own stream so it overlaps the training step.
+
+        Example:
+        >>> relabeler = OnlineRelabeler(teacher, relabelset, label_cache, subset_size=500, threshold=0.8)
+        >>> relabeler.refresh(teacher)  # every few thousand iterations
+    """
+    def __init__(self, teacher, dataset, cache, subset_size=500, threshold=1.0, scales=(1.0, 1.25), batch_size=2,
+                 num_workers=2, device=torch.device('cuda')):
+        self.device = torch.device(device)
+        self.model = copy.deepcopy(teacher).to(self.device).eval()
+        self.tta_model = TTAWrapper(self.model, scales=scales, flips=(False, True), out_size=cache.size)
+        self.dataset = dataset
+        self.cache = cache
+        self.subset_size = min(subset_size, len(dataset))
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.cursor = 0
+        self.thread = None
+        self.error = None
+        self.num_rounds = 0
+        self.round_time = 0.0
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def refresh(self, teacher):
+        """Relabel the next window with the weights of teacher, returns False if the last round is still running."""
+        if self.error is not None:
+            raise self.error
+        if self.busy():
+            return False
+        if self.num_rounds > 0:
+            print('Relabeled round %d in %.1f sec, %d/%d images have online labels' % (
+                self.num_rounds, self.round_time, self.cache.num_valid(), len(self.cache)))
+        self.model.load_state_dict(teacher.state_dict())
+        if self.stream is not None:
+            self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        indices = [(self.cursor + k) % len(self.dataset) for k in range(self.subset_size)]
+        self.cursor = (self.cursor + self.subset_size) % len(self.dataset)
+        self.thread = threading.Thread(target=self._run, args=(indices,))
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def _run(self, indices):
+        try:
+            if self.stream is not None:
+                torch.cuda.set_device(self.device)
+                with torch.cuda.stream(self.stream):
+                    self._relabel(indices)
+            else:
+                self._relabel(indices)
+        except Exception as e:
+            self.error = e
+
+    def _relabel(self, indices):
+        tt = time.time()
+        loader = data.DataLoader(data.Subset(self.dataset, indices), batch_size=self.batch_size,
+                                 shuffle=False, num_workers=self.num_workers,
+                                 multiprocessing_context='spawn' if self.num_workers > 0 else None)
+        num_passes = len(self.tta_model.flips) * len(self.tta_model.scales)
+        k = 0
+        with torch.no_grad():
+            for batch in loader:
+                images = batch[0]
+                tta, _ = self.tta_model([image.to(self.device) for image in images])
+                pred, score = tta.argmax_max()
+                if self.threshold < 1.0:
+                    pred[score < self.threshold * num_passes] = 255
+                pred = pred.byte().cpu()
+                for i in range(pred.shape[0]):
+                    self.cache.put(indices[k], pred[i])
+                    k += 1
+        self.num_rounds += 1
+        self.round_time = time.time() - tt
+
+
+class _ToyTwoHead(torch.nn.Module):
+    def __init__(self, num_classes=5):
+        super(_ToyTwoHead, self).__init__()
+        self.head1 = torch.nn.Conv2d(3, num_classes, 8, stride=8)
+        self.head2 = torch.nn.Conv2d(3, num_classes, 8, stride=8)
+        for head in (self.head1, self.head2):  # confident enough that some pixels pass the threshold
+            head.weight.data.mul_(20)
+
+    def forward(self, x):
+        return self.head1(x), self.head2(x)
+
+
+class _ToyMultiScaleSet(data.Dataset):
+    """Stands in for cityscapesMultiScaleDataSet: image i is seeded by i, single scale."""
+    def __init__(self, num_images, size):
+        self.images = [torch.randn(3, size[0], size[1], generator=torch.Generator().manual_seed(i))
+                       for i in range(num_images)]
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        if self.images[index] is None:
+            raise IOError('image %d cannot be read' % index)
+        return [self.images[index]], torch.zeros(0), torch.tensor(self.images[index].shape[1:]), str(index)
+
+
+def check(num_images=7, subset_size=5, size=(64, 128), threshold=0.6):
+    import torch.nn.functional as F
+    from dataset.label_cache import SharedLabelCache
+    torch.manual_seed(0)
+    teacher = _ToyTwoHead().eval()
+    dataset = _ToyMultiScaleSet(num_images, size)
+    cache = SharedLabelCache(num_images, size=size)
+    relabeler = OnlineRelabeler(teacher, dataset, cache, subset_size=subset_size, threshold=threshold,
+                                scales=(1.0,), num_workers=0, device='cpu')
+
+    # first round labels 0..4, the second wraps around to 5, 6, 0, 1, 2
+    assert relabeler.refresh(teacher)
+    relabeler.thread.join()
+    assert cache.num_valid() == subset_size and not cache.valid[subset_size:].any()
+    assert relabeler.refresh(teacher)
+    relabeler.thread.join()
+    assert relabeler.error is None and cache.num_valid() == num_images
+    assert relabeler.cursor == (2 * subset_size) % num_images
+
+    # direct flip TTA of every image, compared with the label cached at its index
+    with torch.no_grad():
+        for index in range(num_images):
+            image = dataset.images[index].unsqueeze(0)
+            prob = 0
+            for flip in (False, True):
+                output1, output2 = teacher(torch.flip(image, [3]) if flip else image)
+                output = 0.5 * output1 + output2
+                prob = prob + F.softmax(torch.flip(output, [3]) if flip else output, dim=1)
+            prob = F.interpolate(prob, size=size, mode='bilinear', align_corners=True)
+            score, pred = torch.max(prob, dim=1)
+            pred[score < threshold * 2] = 255
+            agreement = (cache.labels[index] == pred[0].byte()).float().mean().item()
+            assert agreement == 1.0, 'image %d: %.4f of the cached label matches' % (index, agreement)
+            assert (pred == 255).any() and (pred != 255).any(), 'threshold left nothing to compare'
+
+    # an error in the thread (an unreadable image) comes back on the next refresh
+    dataset.images[relabeler.cursor] = None
+    assert relabeler.refresh(teacher)
+    relabeler.thread.join()
+    assert relabeler.error is not None
+    try:
+        relabeler.refresh(teacher)
+    except IOError:
+        pass
+    else:
+        raise AssertionError('the background error was not raised by refresh()')
+    print('OnlineRelabeler check passed: %d images in rounds of %d, threshold %.1f' % (num_images, subset_size, threshold))
+
+
+if __name__ == '__main__':
+    check()
@@ -27,7 +27,7 @@ class EMAWeightOptimizer(object):
         self.source_params = list(source_net.state_dict().values())
 
         for tgt_p, src_p in zip(self.target_params, self.source_params):
-            tgt_p[:] = src_p[:]
+            tgt_p.copy_(src_p)
 
         target_keys = set(target_net.state_dict().keys())
         source_keys = set(source_net.state_dict().keys())
@@ -39,5 +39,9 @@ class EMAWeightOptimizer(object):
     def step(self):
         one_minus_alpha = 1.0 - self.ema_alpha
         for tgt_p, src_p in zip(self.target_params, self.source_params):
+            # integer buffers such as BatchNorm's num_batches_tracked are copied, not averaged
+            if not tgt_p.dtype.is_floating_point:
+                tgt_p.copy_(src_p)
+                continue
             tgt_p.mul_(self.ema_alpha)
             tgt_p.add_(src_p * one_minus_alpha)
\ No newline at end of file
@@ -0,0 +1,98 @@
+import queue
+import threading
+import time
+import torch
+from utils.tool import normalize_batch
+
+
+class DevicePrefetcher(object):
+    """ Move loader batches to `device` ahead of time, overlapping the copy with compute.
+
+        A background thread pulls batches from the loader and stages them:
+        images and labels are copied to the device (on a side stream on
+        CUDA, so the copy overlaps the running step), labels are turned into
+        int64 on the device, and uint8 images are normalized with
+        normalize_batch when `mean` is given. Batches are
+        (images, labels, size, name) tuples or tuples of those, as yielded
+        by the paired loader. Works the same on torch.device('cpu').
+
+        Example:
+        >>> prefetcher = DevicePrefetcher(loader, next(model.parameters()).device, mean=IMG_MEAN)
+        >>> batch, batch_t = next(prefetcher)
+        >>> data_wait = prefetcher.pop_wait_time()
+    """
+    def __init__(self, loader, device, mean=None, depth=2):
+        self.device = torch.device(device)
+        self.mean = mean
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.wait_time = 0.0
+        self.num_batches = 0
+        self.queue = queue.Queue(maxsize=depth)
+        self.thread = threading.Thread(target=self._worker, args=(iter(loader),))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _stage_batch(self, batch):
+        images, labels = batch[0], batch[1]
+        images = images.to(self.device, non_blocking=True)
+        labels = labels.to(self.device, non_blocking=True).long()
+        if self.mean is not None and images.dtype == torch.uint8:
+            images = normalize_batch(images, self.mean)
+        return (images, labels) + tuple(batch[2:])
+
+    def _stage(self, batch):
+        if isinstance(batch[0], (list, tuple)):
+            return tuple(self._stage_batch(b) for b in batch)
+        return self._stage_batch(batch)
+
+    def _worker(self, loader_iter):
+        if self.stream is not None:
+            torch.cuda.set_device(self.device)
+        while True:
+            try:
+                batch = next(loader_iter)
+            except StopIteration:
+                self.queue.put((None, None))
+                return
+            except Exception as e:
+                self.queue.put((e, None))
+                return
+            if self.stream is not None:
+                with torch.cuda.stream(self.stream):
+                    batch = self._stage(batch)
+                    event = torch.cuda.Event()
+                    event.record(self.stream)
+            else:
+                batch = self._stage(batch)
+                event = None
+            self.queue.put((batch, event))
+
+    def _record(self, batch):
+        # tensors were allocated on the side stream but are used on the current one
+        for item in batch:
+            if isinstance(item, (list, tuple)):
+                self._record(item)
+            elif torch.is_tensor(item) and item.is_cuda:
+                item.record_stream(torch.cuda.current_stream(self.device))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        tt = time.time()
+        batch, event = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        if batch is None:
+            raise StopIteration
+        if event is not None:
+            torch.cuda.current_stream(self.device).wait_event(event)
+            self._record(batch)
+        self.wait_time += time.time() - tt
+        self.num_batches += 1
+        return batch
+
+    def pop_wait_time(self):
+        """Seconds spent waiting on data since the last call."""
+        wait_time, self.wait_time = self.wait_time, 0.0
+        return wait_time
@@ -1,3 +1,4 @@
+import os
 import torch
 import time
 
@@ -33,12 +34,51 @@ def adjust_learning_rate_D(optimizer, i_iter, args):
     #    optimizer.param_groups[1]['lr'] = lr * 10
 
 
+TRAINER_MODULES = {'G': '.pth', 'D1': '_D1.pth', 'D2': '_D2.pth'}
+TRAINER_OPTIMIZERS = ('gen_opt', 'dis1_opt', 'dis2_opt')
+
+
+def _unwrap(module):
+    return module.module if hasattr(module, 'module') else module
+
+
+def save_optimizers(trainer, path):
+    '''optimizer states of a trainer, saved next to its snapshot so --start-step can resume from it'''
+    torch.save({name: getattr(trainer, name).state_dict() for name in TRAINER_OPTIMIZERS if hasattr(trainer, name)}, path)
+
+
+def resume_snapshot(trainer, prefix):
+    '''load the networks and optimizers of the snapshot saved as prefix + .pth, _D1.pth, _D2.pth and _opt.pth'''
+    for name, suffix in TRAINER_MODULES.items():
+        if not hasattr(trainer, name):
+            continue
+        path = prefix + suffix
+        if not os.path.isfile(path):
+            raise ValueError('Cannot resume, %s is missing.' % path)
+        # snapshots of DataParallel runs carry a module. prefix
+        state_dict = {k[7:] if k.startswith('module.') else k: v
+                      for k, v in torch.load(path, map_location='cpu').items()}
+        _unwrap(getattr(trainer, name)).load_state_dict(state_dict)
+    path = prefix + '_opt.pth'
+    if not os.path.isfile(path):
+        raise ValueError('Cannot resume, %s is missing; only snapshots saving their optimizer state can be resumed.' % path)
+    for name, state_dict in torch.load(path, map_location='cpu').items():
+        getattr(trainer, name).load_state_dict(state_dict)
+    print('Resumed weights and optimizer state from %s' % prefix)
+
+
 def fliplr(img):
     '''flip horizontal'''
     inv_idx = torch.arange(img.size(3)-1,-1,-1).long().to(img.device)  # N x C x H x W
     img_flip = img.index_select(3,inv_idx)
     return img_flip
 
+def normalize_batch(images, mean):
+    '''uint8 RGB N x H x W x C batch -> float BGR N x C x H x W batch minus mean'''
+    mean = torch.as_tensor(mean, dtype=torch.float32, device=images.device).view(1, -1, 1, 1)
+    images = images.permute(0, 3, 1, 2).flip(1).float()
+    return (images - mean).contiguous()
+
 class Timer:
     def __init__(self, msg):
         self.msg = msg